@@ -1,48 +1,596 @@
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import os
+import shutil
+import zipfile
 import numpy
-import arcpy
+import pandas
 
-def getAverageHeadways(stopId):
+# arcpy is only needed to read the geodatabase table, GTFS feeds can be read without it
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+# Table of scheduled bus arrivals and the Mon/Wed/Thurs service ids used for the Master Plan
+stopTimesTable = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb/GTFS_2020_09_02_StopTimes_Weekdays_09_14"
+weekdayServiceIds = (4, 9, 19, 20, 21, 25)
+feedDate = "2020_09_02"
+# Those ids only mean something in that table, so GTFS feeds default to this day's services in calendar.txt
+feedWeekday = "wednesday"
+
+# Folder for the stop time indexes built by buildStopTimeIndex
+indexFolder = "D:/Documents/ArcGIS/Projects/NewarkGeneral/StopTimeIndex"
+
+# Time of day buckets for getHeadwayProfiles, as (name, start, end) in seconds after midnight.
+# GTFS times run past 24:00:00 for trips after midnight, so the last buckets go to 30:00:00
+hourlyBuckets = [("{:02d}:00".format(hour), hour * 3600, (hour + 1) * 3600) for hour in range(30)]
+periodBuckets = [
+    ("Early AM", 0, 6 * 3600),
+    ("AM Peak", 6 * 3600, 9 * 3600),
+    ("Midday", 9 * 3600, 15 * 3600),
+    ("PM Peak", 15 * 3600, 19 * 3600),
+    ("Evening", 19 * 3600, 22 * 3600),
+    ("Night", 22 * 3600, 30 * 3600)
+]
+
+# Results of each getAllHeadways call keyed by (source, serviceIds), so single stop lookups
+# don't query the table again and other feeds don't replace the default table's results
+headwayResults = {}
+# Stop time index opened by getFirstOrLastBus
+stopTimeIndex = None
+
+def parseTimes(times):
+    """
+    Function to convert an array of "H:MM:SS" or "HH:MM:SS" text
+    times to seconds after midnight. Times past 24:00:00 are kept as
+    is, blank times come back as -1, anything else raises ValueError
+    """
+    # Strip before anything else, so padded times aren't cut short
+    times = numpy.char.strip(numpy.asarray(times, dtype=str))
+    if times.size == 0:
+        return numpy.zeros(0, numpy.int32)
+    blank = times == ""
+    valid = pandas.Series(times).str.fullmatch(r"\d+:[0-5]\d:[0-5]\d").to_numpy()
+    if not (valid | blank).all():
+        raise ValueError("Times must be H:MM:SS, got {}".format(times[~(valid | blank)][:5].tolist()))
+    # Pad to the longest time, then read each character as its digit value
+    width = max(8, int(numpy.char.str_len(times).max()))
+    digits = numpy.char.zfill(times, width).astype("U{}".format(width)).view(numpy.uint32).reshape(-1, width).astype(numpy.int32) - 48
+    hours = digits[:, :width - 6].dot(10 ** numpy.arange(width - 7, -1, -1, dtype=numpy.int32))
+    seconds = (hours * 3600
+        + (digits[:, -5] * 10 + digits[:, -4]) * 60
+        + (digits[:, -2] * 10 + digits[:, -1]))
+    seconds[blank] = -1
+    return seconds.astype(numpy.int32)
+
+def openFeedFile(feed, name):
+    """
+    Function to open one of the text files of a GTFS feed,
+    either zipped or unzipped in a folder
+    """
+    if feed.lower().endswith(".zip"):
+        archive = zipfile.ZipFile(feed)
+        # Some feeds are zipped with the files inside a subfolder
+        member = next((n for n in archive.namelist() if n == name or n.endswith("/" + name)), None)
+        if member is None:
+            archive.close()
+            raise FileNotFoundError("{} not found in {}".format(name, feed))
+        return io.TextIOWrapper(archive.open(member), encoding="utf-8-sig")
+    return open(os.path.join(feed, name), encoding="utf-8-sig", newline="")
+
+def isFeed(source):
+    """Function to check whether a source is a GTFS feed (zip or folder) rather than a table"""
+    return source.lower().endswith(".zip") or os.path.isdir(source)
+
+def hasFeedFile(feed, name):
+    """Function to check whether a GTFS feed includes one of the optional text files"""
+    if feed.lower().endswith(".zip"):
+        with zipfile.ZipFile(feed) as archive:
+            return any(n == name or n.endswith("/" + name) for n in archive.namelist())
+    return os.path.exists(os.path.join(feed, name))
+
+def getServiceIds(feed, day=None, date=None):
+    """
+    Function to get the service ids running on a day of the week
+    (e.g. "wednesday") from a GTFS feed's calendar.txt. If a date
+    ("YYYYMMDD") is given, only services in effect on that date are
+    kept and the exceptions in calendar_dates.txt are applied
+    """
+    if date is not None:
+        day = datetime.datetime.strptime(str(date), "%Y%m%d").strftime("%A").lower()
+    services = set()
+    if hasFeedFile(feed, "calendar.txt"):
+        with openFeedFile(feed, "calendar.txt") as f:
+            calendar = pandas.read_csv(f, dtype=str, keep_default_na=False)
+        running = calendar[day.lower()].str.strip() == "1"
+        if date is not None:
+            running &= (calendar["start_date"] <= str(date)) & (calendar["end_date"] >= str(date))
+        services.update(calendar.loc[running, "service_id"])
+    if date is not None and hasFeedFile(feed, "calendar_dates.txt"):
+        with openFeedFile(feed, "calendar_dates.txt") as f:
+            exceptions = pandas.read_csv(f, dtype=str, keep_default_na=False)
+        exceptions = exceptions[exceptions["date"] == str(date)]
+        # exception_type 1 adds service on the date, 2 removes it
+        services.update(exceptions.loc[exceptions["exception_type"] == "1", "service_id"])
+        services.difference_update(exceptions.loc[exceptions["exception_type"] == "2", "service_id"])
+    return sorted(services)
+
+def readFeedStopTimes(feed, serviceIds=None, chunkSize=1000000, withTrips=False):
+    """
+    Function to stream stop_times.txt from a GTFS feed (zip or folder)
+    in chunks, keeping only trips with the given service ids, returns
+    the unique stop ids, each arrival's index into them and the
+    arrival times in seconds (plus a trip number for each arrival if
+    withTrips is set)
+    """
+    if isinstance(serviceIds, str):
+        # A day name or YYYYMMDD date, so look up the services from the calendar
+        serviceIds = getServiceIds(feed, date=serviceIds) if serviceIds.isdigit() else getServiceIds(feed, day=serviceIds)
+    keepTrips = None
+    if serviceIds is not None:
+        services = set(str(s) for s in serviceIds)
+        with openFeedFile(feed, "trips.txt") as f:
+            trips = pandas.read_csv(f, usecols=["trip_id", "service_id"], dtype=str, keep_default_na=False)
+        keepTrips = trips.loc[trips["service_id"].isin(services), "trip_id"].to_numpy()
+        del trips
+
+    # Stop ids are stored once in stopCodes, each chunk only keeps compact integer arrays
+    stopCodes = {}
+    tripCodes = {}
+    codeChunks = []
+    tripChunks = []
+    secondChunks = []
+    with openFeedFile(feed, "stop_times.txt") as f:
+        chunks = pandas.read_csv(
+            f,
+            usecols=["trip_id", "arrival_time", "stop_id"],
+            dtype=str,
+            keep_default_na=False,
+            chunksize=chunkSize)
+        for chunk in chunks:
+            if keepTrips is not None:
+                chunk = chunk[chunk["trip_id"].isin(keepTrips)]
+            # No trips of these services in this chunk
+            if chunk.empty:
+                continue
+            seconds = parseTimes(chunk["arrival_time"].to_numpy(dtype=str))
+            # Stops without a scheduled time at this point in the trip can't be used for headways
+            timed = seconds >= 0
+            chunkCodes, chunkStops = pandas.factorize(chunk["stop_id"].to_numpy()[timed])
+            globalCodes = numpy.array([stopCodes.setdefault(stop, len(stopCodes)) for stop in chunkStops], dtype=numpy.int32)
+            codeChunks.append(globalCodes[chunkCodes] if len(chunkCodes) else chunkCodes.astype(numpy.int32))
+            secondChunks.append(seconds[timed])
+            if withTrips:
+                chunkTrips, chunkTripIds = pandas.factorize(chunk["trip_id"].to_numpy()[timed])
+                globalTrips = numpy.array([tripCodes.setdefault(trip, len(tripCodes)) for trip in chunkTripIds], dtype=numpy.int32)
+                tripChunks.append(globalTrips[chunkTrips] if len(chunkTrips) else chunkTrips.astype(numpy.int32))
+
+    stops = numpy.array(list(stopCodes), dtype=str)
+    stopIndex = numpy.concatenate(codeChunks) if codeChunks else numpy.zeros(0, numpy.int32)
+    seconds = numpy.concatenate(secondChunks) if secondChunks else numpy.zeros(0, numpy.int32)
+    # Renumber so the stop ids are in sorted order, like numpy.unique gives for the other sources
+    order = numpy.argsort(stops)
+    rank = numpy.empty(len(stops), dtype=numpy.int32)
+    rank[order] = numpy.arange(len(stops))
+    if withTrips:
+        trips = numpy.concatenate(tripChunks) if tripChunks else numpy.zeros(0, numpy.int32)
+        return stops[order], rank[stopIndex], seconds, trips
+    return stops[order], rank[stopIndex], seconds
+
+def resolveServiceIds(source, serviceIds):
+    """Function to get the service filter actually run for a source, the
+    default weekdayServiceIds become feedWeekday for GTFS feeds"""
+    if serviceIds is weekdayServiceIds and (source.lower().endswith(".txt") or isFeed(source)):
+        return feedWeekday
+    return serviceIds
+
+def readStopTimes(source=stopTimesTable, serviceIds=weekdayServiceIds, chunkSize=1000000, withTrips=False):
+    """
+    Function to read the stop ids and arrival times (in seconds)
+    from a stop times table, a GTFS zip or stop_times.txt in one pass,
+    returns the unique stop ids, each arrival's index into them and the
+    arrival times (plus a trip number for each arrival if withTrips is
+    set). For GTFS feeds serviceIds can also be a day name or YYYYMMDD
+    date to look the services up in the calendar (the default
+    weekdayServiceIds become feedWeekday for feeds)
+    """
+    if source.lower().endswith(".txt") or isFeed(source):
+        feed = os.path.dirname(source) if source.lower().endswith(".txt") else source
+        return readFeedStopTimes(feed, resolveServiceIds(source, serviceIds), chunkSize, withTrips)
+
+    if arcpy is None:
+        raise ImportError("arcpy is needed to read {}, use a GTFS feed instead".format(source))
+    where = None
+    if serviceIds is not None:
+        where = "service_id IN ({})".format(",".join(str(s) for s in serviceIds))
+    fieldNames = ["stop_id", "arrival_time", "trip_id"] if withTrips else ["stop_id", "arrival_time"]
+    table = arcpy.da.TableToNumPyArray(source, fieldNames, where_clause=where)
+    seconds = parseTimes(table["arrival_time"])
+    timed = seconds >= 0
+    stops, stopIndex = numpy.unique(table["stop_id"].astype(str)[timed], return_inverse=True)
+    if withTrips:
+        trips = numpy.unique(table["trip_id"].astype(str)[timed], return_inverse=True)[1]
+        return stops, stopIndex, seconds[timed], trips
+    return stops, stopIndex, seconds[timed]
+
+def sortStopTimes(stops, stopIndex, seconds):
+    """
+    Function to group arrival times by stop, returns the unique
+    stop ids, the offset of each stop's first arrival and the
+    arrivals sorted by stop then time
+    """
+    # Sort arrivals by stop then time, so each stop's arrivals sit next to each other in order
+    order = numpy.lexsort((seconds, stopIndex))
+    counts = numpy.bincount(stopIndex, minlength=len(stops))
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+    return stops, offsets, seconds[order].astype(numpy.int32)
+
+def summarizeHeadways(offsets, arrivals):
+    """
+    Function to get the mean, median and max headway (in minutes)
+    of each stop from arrivals grouped by sortStopTimes
+    """
+    stopCount = len(offsets) - 1
+    stopIndex = numpy.repeat(numpy.arange(stopCount), numpy.diff(offsets))
+    # numpy.diff gets the headway between each arrival and the next,
+    # only keep the ones where both arrivals are at the same stop
+    headways = numpy.diff(arrivals) / 60
+    sameStop = stopIndex[1:] == stopIndex[:-1]
+    headways = headways[sameStop]
+    headwayStop = stopIndex[1:][sameStop]
+
+    counts = numpy.bincount(headwayStop, minlength=stopCount)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        means = numpy.bincount(headwayStop, weights=headways, minlength=stopCount) / counts
+
+    # Sort the headways within each stop to pick out the median and max
+    sortedHeadways = headways[numpy.lexsort((headways, headwayStop))]
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    hasHeadways = counts > 0
+    medians = numpy.full(stopCount, numpy.nan)
+    maxes = numpy.full(stopCount, numpy.nan)
+    lowMid = starts[hasHeadways] + (counts[hasHeadways] - 1) // 2
+    highMid = starts[hasHeadways] + counts[hasHeadways] // 2
+    medians[hasHeadways] = (sortedHeadways[lowMid] + sortedHeadways[highMid]) / 2
+    maxes[hasHeadways] = sortedHeadways[starts[hasHeadways] + counts[hasHeadways] - 1]
+    return means, medians, maxes
+
+def profileHeadways(offsets, arrivals, buckets=periodBuckets):
+    """
+    Function to get the mean headway (in minutes) and number of
+    arrivals of each stop in each time of day bucket from arrivals
+    grouped by sortStopTimes, returns two stop x bucket arrays
+    """
+    stopCount = len(offsets) - 1
+    starts = numpy.array([toSeconds(bucket[1]) for bucket in buckets])
+    ends = numpy.array([toSeconds(bucket[2]) for bucket in buckets])
+    if numpy.any(starts[1:] < ends[:-1]):
+        raise ValueError("Time buckets must be in order and not overlap")
+    bucketCount = len(buckets)
+    stopIndex = numpy.repeat(numpy.arange(stopCount), numpy.diff(offsets))
+
+    # Find the bucket of every arrival, arrivals in gaps between buckets get -1
+    bucketIndex = numpy.searchsorted(starts, arrivals, side="right") - 1
+    inBucket = (bucketIndex >= 0) & (arrivals < ends[numpy.maximum(bucketIndex, 0)])
+    bucketIndex[~inBucket] = -1
+    cells = stopIndex * bucketCount + bucketIndex
+    trips = numpy.bincount(cells[inBucket], minlength=stopCount * bucketCount)
+
+    # Only count headways between two arrivals at the same stop in the same bucket,
+    # so the overnight gap doesn't end up in the first bucket of the day
+    headways = numpy.diff(arrivals) / 60
+    sameCell = inBucket[1:] & (cells[1:] == cells[:-1])
+    headwayCells = cells[1:][sameCell]
+    counts = numpy.bincount(headwayCells, minlength=stopCount * bucketCount)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        means = numpy.bincount(headwayCells, weights=headways[sameCell], minlength=stopCount * bucketCount) / counts
+    return means.reshape(stopCount, bucketCount), trips.reshape(stopCount, bucketCount)
+
+def getAllHeadways(source=stopTimesTable, serviceIds=weekdayServiceIds):
+    """
+    Function to get the mean, median and max time between bus
+    arrivals (in minutes) for every bus stop in one read of the
+    stop times, returns a dict keyed by stop id
+    """
+    stops, offsets, arrivals = sortStopTimes(*readStopTimes(source, serviceIds))
+    means, medians, maxes = summarizeHeadways(offsets, arrivals)
+
+    results = {}
+    for i, stop in enumerate(stops):
+        results[str(stop)] = {"mean": float(means[i]), "median": float(medians[i]), "max": float(maxes[i])}
+    headwayResults[getHeadwayKey(source, serviceIds)] = results
+    return results
+
+def getHeadwayKey(source, serviceIds):
+    """Function to get the headwayResults key of a source and service filter (lists made hashable)"""
+    return source, serviceIds if serviceIds is None or isinstance(serviceIds, str) else tuple(serviceIds)
+
+def toSeconds(time):
+    """
+    Function to convert a "HH:MM:SS" time (or a number of seconds) to seconds after midnight
+    """
+    return int(parseTimes([time])[0]) if isinstance(time, str) else int(time)
+
+def formatTime(seconds):
+    """
+    Function to convert seconds after midnight back to "HH:MM:SS"
+    """
+    seconds = int(seconds)
+    return "{:02d}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class StopTimeIndex(object):
+    def __init__(self, folder):
+        """
+        Memory mapped stop time index written by buildStopTimeIndex,
+        each stop's sorted arrivals are arrivals[offsets[i]:offsets[i + 1]]
+        """
+        self.folder = folder
+        self.stops = numpy.load(os.path.join(folder, "stops.npy"))
+        self.offsets = numpy.load(os.path.join(folder, "offsets.npy"), mmap_mode="r")
+        self.arrivals = numpy.load(os.path.join(folder, "arrivals.npy"), mmap_mode="r")
+        self.positions = {str(stop): i for i, stop in enumerate(self.stops)}
+
+    def stopArrivals(self, stopId):
+        """Sorted arrival times (in seconds) for a stop, empty if the stop isn't scheduled"""
+        i = self.positions.get(str(stopId))
+        if i is None:
+            return self.arrivals[:0]
+        return self.arrivals[self.offsets[i]:self.offsets[i + 1]]
+
+    def firstBus(self, stopId):
+        """First scheduled arrival at a stop, formatted HH:MM:SS"""
+        times = self.stopArrivals(stopId)
+        return formatTime(times[0]) if len(times) > 0 else None
+
+    def lastBus(self, stopId):
+        """Last scheduled arrival at a stop, formatted HH:MM:SS"""
+        times = self.stopArrivals(stopId)
+        return formatTime(times[-1]) if len(times) > 0 else None
+
+    def spanOfService(self, stopId):
+        """Minutes between the first and last scheduled arrival at a stop"""
+        times = self.stopArrivals(stopId)
+        return (int(times[-1]) - int(times[0])) / 60 if len(times) > 0 else numpy.nan
+
+    def headways(self, stopId):
+        """Minutes between each scheduled arrival at a stop and the next"""
+        return numpy.diff(self.stopArrivals(stopId)) / 60
+
+    def allHeadways(self):
+        """Mean, median and max headway for every stop, same as getAllHeadways"""
+        means, medians, maxes = summarizeHeadways(numpy.asarray(self.offsets), numpy.asarray(self.arrivals))
+        return {str(stop): {"mean": float(means[i]), "median": float(medians[i]), "max": float(maxes[i])}
+            for i, stop in enumerate(self.stops)}
+
+    def headwayProfiles(self, buckets=periodBuckets):
+        """Mean headway and arrivals for every stop and time of day bucket, same as getHeadwayProfiles"""
+        headways, trips = profileHeadways(numpy.asarray(self.offsets), numpy.asarray(self.arrivals), buckets)
+        names = [bucket[0] for bucket in buckets]
+        return (pandas.DataFrame(headways, index=self.stops, columns=names),
+            pandas.DataFrame(trips, index=self.stops, columns=names))
+
+def getSourceKey(source):
+    """
+    Function to get a short key for a stop times source from its full
+    path and modified time, so a changed or different feed gets its
+    own index. A table in a geodatabase goes by the geodatabase folder
+    """
+    source = os.path.abspath(source)
+    existing = source
+    while not os.path.exists(existing) and os.path.dirname(existing) != existing:
+        existing = os.path.dirname(existing)
+    modified = os.path.getmtime(existing) if os.path.exists(existing) else 0
+    key = hashlib.sha1("{}|{}".format(source, modified).encode()).hexdigest()[:10]
+    return "{}_{}".format(os.path.splitext(os.path.basename(source))[0], key)
+
+def buildStopTimeIndex(feedDate=feedDate, source=stopTimesTable, serviceIds=weekdayServiceIds, folder=indexFolder, rebuild=False):
+    """
+    Function to parse the stop times once and save them as a columnar
+    index of .npy files, keyed by the GTFS feed date, the source (its
+    path and modified time) and service ids. An index already built for
+    the same source is reused unless rebuild is set
+    """
+    if serviceIds is None:
+        serviceKey = "all"
+    elif isinstance(serviceIds, str):
+        # A day name or YYYYMMDD date is one value, not a list of characters
+        serviceKey = serviceIds
+    else:
+        serviceKey = "-".join(str(s) for s in serviceIds)
+    indexPath = os.path.join(folder, "{}_{}_{}".format(feedDate, getSourceKey(source), serviceKey))
+    if rebuild or not os.path.exists(os.path.join(indexPath, "arrivals.npy")):
+        stops, offsets, arrivals = sortStopTimes(*readStopTimes(source, serviceIds))
+        # Write to a temporary folder first, so a half written index is never picked up
+        tempPath = indexPath + ".tmp"
+        os.makedirs(tempPath, exist_ok=True)
+        numpy.save(os.path.join(tempPath, "stops.npy"), stops.astype(str))
+        numpy.save(os.path.join(tempPath, "offsets.npy"), offsets)
+        numpy.save(os.path.join(tempPath, "arrivals.npy"), arrivals)
+        if os.path.exists(indexPath):
+            shutil.rmtree(indexPath)
+        os.replace(tempPath, indexPath)
+    return StopTimeIndex(indexPath)
+
+def getAverageHeadways(stopId, source=stopTimesTable, serviceIds=weekdayServiceIds):
     """
     Function to get the average time between bus arrivals
-    for a given bus stop (stopId)
+    for a given bus stop (stopId), from the default stop times
+    table unless another source or service filter is given
     """
-    # Query the table of scheduled bus arrivals for the specified bus stop on Mon/Wed/Thurs Schedules
-    rows = arcpy.SearchCursor(
-        "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb/GTFS_2020_09_02_StopTimes_Weekdays_09_14",
-        where_clause="stop_id={} AND service_id IN (4,9,19,20,21,25)".format(stopId),
-        fields="stop_id; arrival_time; service_id",
-        sort_fields="arrival_time A")
-    times = []
-    for row in rows:
-        rowtime = row.getValue("arrival_time")
-        # The following two lines are to convert the text time to a simple number (seconds) so we can calculate differences
-        timeels = rowtime.split(":")
-        rowsecs = (float(timeels[0]) * 60) + float(timeels[1]) + float(float(timeels[2]) / 60)
-        times.append(rowsecs)
-    # numpy.diff is doing most of the work to get the headways between bus arrivals
-    # it will quickly calculate the difference between each element in an array and the one following it
-    headways = numpy.diff(times)
-    # the following line just calculates the average of the headways
-    return numpy.mean(headways)
+    # Read every stop's headways the first time, after that it's just a lookup
+    key = getHeadwayKey(source, serviceIds)
+    if key not in headwayResults:
+        getAllHeadways(source, serviceIds)
+    stop = headwayResults[key].get(str(stopId))
+    return numpy.nan if stop is None else stop["mean"]
 
-import numpy
-import arcpy
+def getHeadwayProfiles(source=stopTimesTable, serviceIds=weekdayServiceIds, buckets=periodBuckets):
+    """
+    Function to get the average time between bus arrivals and the
+    number of arrivals for every bus stop in each time of day bucket
+    (periodBuckets, hourlyBuckets or a list of (name, start, end) with
+    "HH:MM:SS" times), returns stop x bucket DataFrames of headways
+    (in minutes) and arrivals
+    """
+    stops, offsets, arrivals = sortStopTimes(*readStopTimes(source, serviceIds))
+    headways, trips = profileHeadways(offsets, arrivals, buckets)
+    names = [bucket[0] for bucket in buckets]
+    return (pandas.DataFrame(headways, index=stops, columns=names),
+        pandas.DataFrame(trips, index=stops, columns=names))
 
 def getFirstOrLastBus(stopId, firstOrLast):
     """
     Function to get the first or last (firstOrLast) scheduled bus arrival
     for a given bus stop (stopId)
     """
-    # Query the table of scheduled bus arrivals for the specified bus stop on Mon/Wed/Thurs Schedules
-    rows = arcpy.SearchCursor(
-        "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb/GTFS_2020_09_02_StopTimes_Weekdays_09_14",
-        where_clause="stop_id={} AND service_id IN (4,9,19,20,21,25)".format(stopId),
-        fields="stop_id; arrival_time; service_id",
-        sort_fields="arrival_time A")
-    times = []
-    # Sets the value of the index of the return statement to correspond to the firstOrLast parameter 
-    position = 0 if firstOrLast == "first" else -1
-    for row in rows:
-        # collect the arrival times for the stop in the times array
-        times.append(row.getValue("arrival_time"))
-    return times[position]
+    # Open (or build the first time) the stop time index, after that it's just an offset lookup
+    global stopTimeIndex
+    if stopTimeIndex is None:
+        stopTimeIndex = buildStopTimeIndex()
+    return stopTimeIndex.firstBus(stopId) if firstOrLast == "first" else stopTimeIndex.lastBus(stopId)
+
+def analyzeFeed(feed, serviceIds):
+    """
+    Function to get headways and first/last bus for every stop of one
+    feed and service calendar, used by compareFeeds in each worker.
+    Returns plain arrays so only small buffers go back to the main process
+    """
+    stops, offsets, arrivals = sortStopTimes(*readStopTimes(feed, serviceIds))
+    means, medians, maxes = summarizeHeadways(offsets, arrivals)
+    firsts = arrivals[offsets[:-1]]
+    lasts = arrivals[offsets[1:] - 1]
+    return stops, means, medians, maxes, firsts, lasts
+
+def compareFeeds(jobs, processes=None):
+    """
+    Function to run the headway and first/last bus analysis for a list
+    of (feed, calendar) jobs across a process pool. Calendar can be a day
+    name, a YYYYMMDD date, a list of service ids or None for every
+    trip. Returns one table keyed by feed (the path as given), calendar
+    (the one actually run) and stop. On Windows call this from under
+    if __name__ == "__main__" so the workers can start
+    """
+    # Resolve the default calendar here, the workers get a copy of it rather than weekdayServiceIds itself
+    jobs = [(feed, resolveServiceIds(feed, calendar)) for feed, calendar in jobs]
+    if len(set((feed, str(calendar)) for feed, calendar in jobs)) < len(jobs):
+        raise ValueError("compareFeeds was given the same feed and calendar more than once")
+    feeds = [job[0] for job in jobs]
+    calendars = [job[1] for job in jobs]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        # map keeps the results in the same order as the jobs
+        results = list(pool.map(analyzeFeed, feeds, calendars))
+
+    tables = []
+    for (feed, calendar), (stops, means, medians, maxes, firsts, lasts) in zip(jobs, results):
+        if calendar is None:
+            # No service filter, every trip in the feed
+            calendarName = "all"
+        elif isinstance(calendar, str):
+            calendarName = calendar
+        else:
+            calendarName = ",".join(str(s) for s in calendar)
+        tables.append(pandas.DataFrame({
+            "feed": feed,
+            "calendar": calendarName,
+            "stop_id": stops,
+            "headway_mean": means,
+            "headway_median": medians,
+            "headway_max": maxes,
+            "first_bus": [formatTime(t) for t in firsts],
+            "last_bus": [formatTime(t) for t in lasts]
+        }))
+    if not tables:
+        tables.append(pandas.DataFrame(columns=["feed", "calendar", "stop_id", "headway_mean", "headway_median", "headway_max", "first_bus", "last_bus"]))
+    return pandas.concat(tables, ignore_index=True).set_index(["feed", "calendar", "stop_id"])
+
+def readStopLocations(feed):
+    """
+    Function to read the stop ids and locations from a GTFS feed's
+    stops.txt, returns the stop ids and x/y in meters on a flat
+    projection centered on the feed
+    """
+    with openFeedFile(feed, "stops.txt") as f:
+        stops = pandas.read_csv(f, usecols=["stop_id", "stop_lat", "stop_lon"], dtype={"stop_id": str})
+    stops = stops.dropna(subset=["stop_lat", "stop_lon"])
+    lat = numpy.radians(stops["stop_lat"].to_numpy(dtype=float))
+    lon = numpy.radians(stops["stop_lon"].to_numpy(dtype=float))
+    # Equirectangular projection is accurate to well under a meter across a city
+    earthRadius = 6371008.8
+    x = earthRadius * (lon - lon.mean()) * numpy.cos(lat.mean())
+    y = earthRadius * (lat - lat.mean())
+    return stops["stop_id"].to_numpy(dtype=str), x, y
+
+def clusterStops(x, y, walkDistance, priority=None):
+    """
+    Function to group stops within walkDistance of each other, using a
+    grid index so only stops in neighboring cells are compared. Stops
+    are taken in priority order (busiest first) and each one that isn't
+    in a cluster yet starts one with every free stop in walking distance,
+    so long lines of stops don't chain into a single cluster.
+    Returns the cluster number of each stop
+    """
+    cellX = numpy.floor(x / walkDistance).astype(numpy.int64)
+    cellY = numpy.floor(y / walkDistance).astype(numpy.int64)
+    grid = {}
+    for i, cell in enumerate(zip(cellX.tolist(), cellY.tolist())):
+        grid.setdefault(cell, []).append(i)
+    grid = {cell: numpy.array(members) for cell, members in grid.items()}
+
+    clusters = numpy.full(len(x), -1, dtype=numpy.int64)
+    order = numpy.arange(len(x)) if priority is None else numpy.argsort(-numpy.asarray(priority), kind="stable")
+    clusterCount = 0
+    for seed in order:
+        if clusters[seed] >= 0:
+            continue
+        # Anything in walking distance has to be in this cell or one of the 8 around it
+        nearby = [grid[(cellX[seed] + dx, cellY[seed] + dy)]
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1) if (cellX[seed] + dx, cellY[seed] + dy) in grid]
+        nearby = numpy.concatenate(nearby)
+        nearby = nearby[clusters[nearby] < 0]
+        close = numpy.hypot(x[nearby] - x[seed], y[nearby] - y[seed]) <= walkDistance
+        clusters[nearby[close]] = clusterCount
+        clusterCount += 1
+    return clusters
+
+def getCorridorHeadways(source=stopTimesTable, serviceIds=weekdayServiceIds, walkDistance=100, stopsFeed=None):
+    """
+    Function to get the combined time between bus arrivals (in minutes)
+    riders see at a corner, by grouping stops within walkDistance
+    (in meters) of each other and merging their arrivals. A bus stopping
+    at more than one stop of a group only counts once. Stop locations
+    come from the feed's stops.txt (stopsFeed if source is a table)
+    """
+    stops, stopIndex, seconds, trips = readStopTimes(source, serviceIds, withTrips=True)
+    feed = stopsFeed if stopsFeed is not None else (os.path.dirname(source) if source.lower().endswith(".txt") else source)
+    locationIds, x, y = readStopLocations(feed)
+
+    # Line up the stop locations with the scheduled stops, unscheduled stops are left out
+    located = pandas.Index(locationIds).get_indexer(stops)
+    if numpy.any(located < 0):
+        raise ValueError("{} scheduled stops are missing from stops.txt".format(int(numpy.sum(located < 0))))
+    arrivalCounts = numpy.bincount(stopIndex, minlength=len(stops))
+    clusters = clusterStops(x[located], y[located], walkDistance, arrivalCounts)
+    clusterCount = int(clusters.max()) + 1 if len(clusters) else 0
+
+    # Keep each trip's first arrival in a cluster, then sort the merged arrivals by cluster and time
+    clusterIndex = clusters[stopIndex]
+    order = numpy.lexsort((seconds, trips, clusterIndex))
+    firstVisit = numpy.ones(len(order), dtype=bool)
+    firstVisit[1:] = (clusterIndex[order][1:] != clusterIndex[order][:-1]) | (trips[order][1:] != trips[order][:-1])
+    keep = order[firstVisit]
+    _, offsets, arrivals = sortStopTimes(numpy.arange(clusterCount), clusterIndex[keep], seconds[keep])
+    means, medians, maxes = summarizeHeadways(offsets, arrivals)
+
+    members = pandas.Series(stops).groupby(clusters).agg(";".join)
+    return pandas.DataFrame({
+        "stop_ids": members.reindex(range(clusterCount)).to_numpy(),
+        "stop_count": numpy.bincount(clusters, minlength=clusterCount),
+        "x": numpy.bincount(clusters, weights=x[located], minlength=clusterCount) / numpy.bincount(clusters, minlength=clusterCount),
+        "y": numpy.bincount(clusters, weights=y[located], minlength=clusterCount) / numpy.bincount(clusters, minlength=clusterCount),
+        "headway_mean": means,
+        "headway_median": medians,
+        "headway_max": maxes
+    }, index=pandas.RangeIndex(clusterCount, name="cluster"))
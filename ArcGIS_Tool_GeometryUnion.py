@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import arcpy
+
+"""
+Geometry Union Helpers for the Select Layer from Text Array Tool
+
+Merges each source row's group of shapes with a balanced (cascaded)
+union, sending large groups to a process pool as WKB. Kept in their
+own module so the pool's workers can import them without the toolbox.
+"""
+
+# Groups with at least this many shapes go to the pool, and it's only
+# started when there are at least this many such groups
+minPoolShapes = 8
+minPoolGroups = 4
+maxWorkers = max(1, (os.cpu_count() or 2) - 1)
+
+def balancedUnion(shapes):
+    """Union shapes in pairs, round by round, so each union is of two
+    similar sized shapes instead of one ever-growing polygon."""
+    shapes = list(shapes)
+    while len(shapes) > 1:
+        shapes = [shapes[i].union(shapes[i + 1]) if i + 1 < len(shapes) else shapes[i]
+                  for i in range(0, len(shapes), 2)]
+    return shapes[0] if shapes else None
+
+def unionWkb(wkbs, wkid):
+    """Pool worker: union a group of WKB shapes, returning WKB."""
+    spatialReference = arcpy.SpatialReference(wkid) if wkid else None
+    return bytes(balancedUnion([arcpy.FromWKB(wkb, spatialReference) for wkb in wkbs]).WKB)
+
+def makePool(workers=maxWorkers):
+    """Process pool that also works inside ArcGIS Pro, where sys.executable
+    is the application rather than python."""
+    python = os.path.join(sys.exec_prefix, "python.exe")
+    if os.path.exists(python) and not sys.executable.lower().endswith("python.exe"):
+        multiprocessing.set_executable(python)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+def unionGroups(groups, wkid=None, usePool=True):
+    """Union each group of shapes, yielding the results in the same order
+    as the groups. Large groups are done in a process pool (a few at a time
+    so they don't all pile up in memory), the rest are done here."""
+    groups = list(groups)
+    large = sum(1 for group in groups if len(group) >= minPoolShapes)
+    if not usePool or large < minPoolGroups:
+        for group in groups:
+            yield balancedUnion(group)
+        return
+    spatialReference = arcpy.SpatialReference(wkid) if wkid else None
+    with makePool() as pool:
+        pending = collections.deque()
+        for group in groups:
+            if len(group) >= minPoolShapes:
+                pending.append(pool.submit(unionWkb, [bytes(shape.WKB) for shape in group], wkid))
+            else:
+                pending.append(balancedUnion(group))
+            while len(pending) > maxWorkers * 4:
+                yield getResult(pending.popleft(), spatialReference)
+        while pending:
+            yield getResult(pending.popleft(), spatialReference)
+
+def getResult(result, spatialReference):
+    """Shape from a pool future, or the shape itself if done here."""
+    if isinstance(result, concurrent.futures.Future):
+        return arcpy.FromWKB(result.result(), spatialReference)
+    return result
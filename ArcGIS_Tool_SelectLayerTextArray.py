@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import json
+import os
+import sys
 import arcpy
 
+# The union and tokenizer helpers sit next to the toolbox, the union helpers also need to be importable by its pool's workers
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ArcGIS_Tool_GeometryUnion
+import Util_TextArrayTokenizer
+
 """
 ArcGIS Custom Python Toolbox
 
@@ -14,6 +20,36 @@ to the primary parcel. Especially when the additional
 parcels are referenced in a one field as a text list.
 """
 
+# Target IDs per IN clause when reading the target layer, and the most batches
+# before it's quicker to read the whole target layer once
+targetBatchSize = 500
+maxTargetBatches = 20
+
+def readTargetShapes(target_layer, target_id_field, target_ids):
+    """Read the target layer once (or in a few IN clause batches),
+    returning a dict of target ID to the shapes with that ID."""
+    target_ids = sorted(set(str(i) for i in target_ids))
+    if len(target_ids) > targetBatchSize * maxTargetBatches:
+        where_clauses = [None]
+    else:
+        where_clauses = []
+        for i in range(0, len(target_ids), targetBatchSize):
+            # Quote each ID, doubling any quotes inside it
+            in_list = ",".join("'{}'".format(t.replace("'", "''")) for t in target_ids[i:i + targetBatchSize])
+            where_clauses.append("{} IN ({})".format(target_id_field, in_list))
+    wanted = set(target_ids)
+    shapes = {}
+    for where_clause in where_clauses:
+        with arcpy.da.SearchCursor(
+            in_table=target_layer,
+            field_names=[target_id_field, 'SHAPE@'],
+            where_clause=where_clause
+        ) as targetCursor:
+            for feat in targetCursor:
+                if str(feat[0]) in wanted:
+                    shapes.setdefault(str(feat[0]), []).append(feat)
+    return shapes
+
 class Toolbox(object):
     def __init__(self):
         """Define the toolbox (the name of the toolbox is the name of the
@@ -135,6 +171,15 @@ class Tool(object):
             direction="Input"
         )
 
+        # Off unless a separator is given, so IDs like "ABC_123" or "L123" are left as they are
+        param11 = arcpy.Parameter(
+            displayName="Normalize Block/Lot Text with Separator (e.g. - for 12-3)",
+            name="blocklot_separator",
+            datatype="GPString",
+            parameterType="Optional",
+            direction="Input"
+        )
+
         params = [
             param0,
             param1,
@@ -146,7 +191,8 @@ class Tool(object):
             param7,
             param8,
             param9,
-            param10
+            param10,
+            param11
         ]
         return params
 
@@ -189,141 +235,113 @@ class Tool(object):
         out_workspace = parameters[8]
         out_name = parameters[9]
         check_others = parameters[10]
+        blocklot_separator = parameters[11].valueAsText or None
 
-        # Lists of data to work with
-        sourceRows = []
-        targetRows = []
+        is_table = output_type.valueAsText == 'Table'
+        out_path = os.path.join(str(out_workspace.value), str(out_name.value))
 
         sourceCursorFields = [source_id_field.valueAsText, source_array_field.valueAsText, 'SHAPE@']
         if source_primary_field.value != None:
             sourceCursorFields.append(source_primary_field.valueAsText)
 
-        # First cursor functions
-        with arcpy.da.SearchCursor(
-            in_table=source_layer,
-            field_names=sourceCursorFields,
-            where_clause="{} IS NOT NULL AND {} <> ''".format(source_array_field.valueAsText, source_array_field.valueAsText)
-            ) as sourceCursor:
-                # Get the array data and insert into sourceRow list
-                for sourceRow in sourceCursor:
-                    field_array = str(sourceRow[1]).split(array_delimiter.value)
-                    if check_others.valueAsText == 'true' and field_array[0] == sourceRow[1]:
-                        no_spaces_txt = str(sourceRow[1]).replace(' ','')
-                        other_delimiters = [",",";","/"]
-                        other_delimiters.remove(array_delimiter.value)
-                        for delimiter in other_delimiters:
-                            new_array = str(no_spaces_txt).split(delimiter)
-                            if len(new_array) > 1:
-                                field_array = new_array
-                                break
-                    if source_primary_field.value != None:
-                        field_array.insert(0, sourceRow[3])
-                    if output_type.valueAsText == 'Table':
-                        sourceRows.append([sourceRow[0], field_array])
-                    else:
-                        sourceRows.append([sourceRow[0], field_array, sourceRow[2]])
-
-        messages.addMessage('Gathered ' + str(len(sourceRows)) + ' Source Records to Search Target Layer For')
-
-        arcpy.SetProgressor("step", "Generating Rows from Target Layer...",
-            0, len(sourceRows), 1)
-
-        mergedRecords = 0
+        delimiters = array_delimiter.value
+        if check_others.valueAsText == 'true':
+            delimiters += Util_TextArrayTokenizer.defaultDelimiters.replace(array_delimiter.value, '')
+
+        # Create the output straight in the workspace and write rows into it as they're made
         messages.addMessage("Generating "+output_type.valueAsText)
-        # Collect the records from the target layer
-        for row in sourceRows:
-            if output_type.valueAsText == 'Table':
-                for target in row[1]:
-                    targetRows.append((row[0],target))
-            else:
-                in_statement = "= '{}'".format(row[1][0]) if len(row[1]) == 1 else "in {}".format(tuple(row[1]))
-                with arcpy.da.SearchCursor(
-                    in_table=target_layer,
-                    field_names=[target_id_field.valueAsText,'SHAPE@'],
-                    where_clause="{} {}".format(target_id_field.valueAsText, in_statement)
-                ) as targetCursor:
-                    cursorChecker = []
-                    newfeat = row[2]
-                    for feat in targetCursor:
-                        if bool(type(row[2]) == type(feat[1])):
-                            newfeat = newfeat.union(feat[1])
-                            cursorChecker.append(feat[0])
-                            mergedRecords = mergedRecords + 1
-                    targetRows.append((
-                        row[0],
-                        str(array_delimiter.valueAsText).join(map(str, row[1])),
-                        str(array_delimiter.valueAsText).join(map(str, cursorChecker)),
-                        newfeat
-                        ))
-            sourceRowsStatus = sourceRows.index(row)
-            arcpy.SetProgressorPosition(sourceRowsStatus)
-        arcpy.ResetProgressor()
-        messages.addMessage('Merged {} Records'.format(mergedRecords))
-        messages.addMessage('Gathered {} Target Records for Output {}\n...Generating Output'.format(len(targetRows),output_type.valueAsText))
-
-        data_json = {
-            "objectIdFieldName": "objectid",
-            "globalIdFieldName": "globalid",
-            "fields": [
-                {
-                    "name": "Source_ID",
-                    "alias": "Source ID",
-                    "type": "esriFieldTypeString",
-                    "length": 255
-                }
-            ],
-            "features": []
-        }
-
-        if output_type.valueAsText == 'Table':
-            targetIDField = {
-                "name": "Target_ID",
-                "alias": "Target ID",
-                "type": "esriFieldTypeString",
-                "length": 255
-            }
-            data_json["fields"].append(targetIDField)
-        else:
-            data_json["geometryType"] = "esriGeometryPolygon"
-            data_json["spatialReference"] = { "wkid" : 102711, "latestWkid" : 3424 }
-            targetIDListField = {
-                "name": "Target_ID_List",
-                "alias": "Target ID List",
-                "type": "esriFieldTypeString",
-                "length": 255
-            }
-            joinedIDListField = {
-                "name": "Joined_ID_List",
-                "alias": "Joined_ID_List",
-                "type": "esriFieldTypeString",
-                "length": 255
-            }
-            data_json["fields"].append(targetIDListField)
-            data_json["fields"].append(joinedIDListField) 
-
-        outData = arcpy.RecordSet(data_json) if output_type.valueAsText == 'Table' else arcpy.FeatureSet(json.dumps(data_json))
-
-        messages.addMessage(outData)
-        messages.addMessage("{} Generated\n...Adding Final Records".format(output_type.valueAsText))
-
-        arcpy.SetProgressor("step", "Generating Final {}...".format(output_type.valueAsText),
-            0, len(targetRows), 1)
-        
-        if output_type.valueAsText == "Table":
+        if is_table:
+            arcpy.management.CreateTable(str(out_workspace.value), str(out_name.value))
             out_fields = ["Source_ID", "Target_ID"]
+            arcpy.management.AddFields(out_path, [
+                ["Source_ID", "TEXT", "Source ID", 255],
+                ["Target_ID", "TEXT", "Target ID", 255]
+            ])
         else:
+            arcpy.management.CreateFeatureclass(str(out_workspace.value), str(out_name.value), "POLYGON",
+                spatial_reference=arcpy.Describe(source_layer).spatialReference)
             out_fields = ["Source_ID", "Target_ID_List", "Joined_ID_List", "SHAPE@"]
+            arcpy.management.AddFields(out_path, [
+                ["Source_ID", "TEXT", "Source ID", 255],
+                ["Target_ID_List", "TEXT", "Target ID List", 255],
+                ["Joined_ID_List", "TEXT", "Joined_ID_List", 255]
+            ])
 
-        # Iterate through targetRows and add to cursor
-        with arcpy.da.InsertCursor(outData, out_fields) as outCursor:
-            for row in targetRows:
-                outCursor.insertRow([row[0],row[1]] if output_type.valueAsText == "Table" else [row[0],row[1],row[2],row[3]])
-                arcpy.SetProgressorPosition(targetRows.index(row))
-            arcpy.ResetProgressor()
-
-        outData.save("{}\{}".format(out_workspace.value,out_name.value))
-        
-        del sourceCursor,outCursor
-
-        messages.addMessage("Done, Output at {}\{}".format(out_workspace.value,out_name.value))
+        sourceRows = []
+        outputRows = 0
+        arcpy.SetProgressor("default", "Reading Source Records...")
+        with arcpy.da.InsertCursor(out_path, out_fields) as outCursor:
+            # First cursor functions
+            with arcpy.da.SearchCursor(
+                in_table=source_layer,
+                field_names=sourceCursorFields,
+                where_clause="{} IS NOT NULL AND {} <> ''".format(source_array_field.valueAsText, source_array_field.valueAsText)
+                ) as sourceCursor:
+                    # Get the array data, a table's rows go straight to the output
+                    for n, sourceRow in enumerate(sourceCursor, 1):
+                        if n % 1000 == 0:
+                            arcpy.SetProgressorLabel("Reading Source Records... {}".format(n))
+                        # Split on the delimiter, or on it and all the others at once,
+                        # expanding block/lot text and lot ranges if normalizing
+                        field_array = list(Util_TextArrayTokenizer.tokenize(str(sourceRow[1]), delimiters, blocklot_separator))
+                        if source_primary_field.value != None:
+                            # A null primary stays None, written as NULL rather than "None"
+                            if blocklot_separator is None or sourceRow[3] is None:
+                                field_array.insert(0, sourceRow[3])
+                            else:
+                                # The primary is written the same way as the array's IDs
+                                field_array[:0] = Util_TextArrayTokenizer.tokenize(str(sourceRow[3]), delimiters, blocklot_separator)
+                        if is_table:
+                            for target in field_array:
+                                outCursor.insertRow([str(sourceRow[0]), None if target is None else str(target)[:255]])
+                            outputRows += len(field_array)
+                        else:
+                            sourceRows.append([sourceRow[0], [t for t in field_array if t is not None], sourceRow[2]])
+
+            if not is_table:
+                messages.addMessage('Gathered ' + str(len(sourceRows)) + ' Source Records to Search Target Layer For')
+                # Read every target ID from all the text arrays in one go, instead of a cursor per source row
+                targetShapes = readTargetShapes(
+                    target_layer, target_id_field.valueAsText, (target for row in sourceRows for target in row[1]))
+                messages.addMessage('Read {} Target IDs from Target Layer'.format(len(targetShapes)))
+
+                mergedRecords = 0
+                joinedLists = []
+                shapeGroups = []
+                for row in sourceRows:
+                    cursorChecker = []
+                    shapeGroup = [row[2]]
+                    # Each ID once, even if it's listed more than once
+                    for target in dict.fromkeys(str(t) for t in row[1]):
+                        for feat in targetShapes.get(target, []):
+                            if bool(type(row[2]) == type(feat[1])):
+                                shapeGroup.append(feat[1])
+                                cursorChecker.append(feat[0])
+                                mergedRecords = mergedRecords + 1
+                    joinedLists.append(str(array_delimiter.valueAsText).join(map(str, cursorChecker)))
+                    shapeGroups.append(shapeGroup)
+                messages.addMessage('Merged {} Records'.format(mergedRecords))
+
+                # Merge each source row's shapes in one union, large groups in parallel, written in source order
+                arcpy.SetProgressor("step", "Merging Shapes and Writing {}...".format(output_type.valueAsText),
+                    0, len(sourceRows), 1)
+                # Move the progressor about every 1%, not on every row
+                progressStep = max(1, len(sourceRows) // 100)
+                wkid = arcpy.Describe(source_layer).spatialReference.factoryCode
+                merged = ArcGIS_Tool_GeometryUnion.unionGroups(shapeGroups, wkid)
+                for i, (row, joinedList, newfeat) in enumerate(zip(sourceRows, joinedLists, merged)):
+                    # Text fields hold 255 characters
+                    outCursor.insertRow([
+                        str(row[0]),
+                        str(array_delimiter.valueAsText).join(map(str, row[1]))[:255],
+                        joinedList[:255],
+                        newfeat
+                        ])
+                    if i % progressStep == 0:
+                        arcpy.SetProgressorPosition(i)
+                outputRows = len(sourceRows)
+                arcpy.ResetProgressor()
+
+        messages.addMessage('Wrote {} Records to Output {}'.format(outputRows, output_type.valueAsText))
+        messages.addMessage("Done, Output at {}".format(out_path))
         return
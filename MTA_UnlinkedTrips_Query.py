@@ -1,7 +1,34 @@
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import urllib.request
+import numpy
 import pandas
 import csv
 import sys
 
+## Folder for the parsed survey, so the Excel file is only
+## downloaded and parsed again when it changes
+cacheFolder = ".survey_cache"
+
+## MTA 2018 Travel Survey (Unlinked), read when no file is given
+surveyURL = r'https://new.mta.info/document/29061'
+
+## Survey columns the transfer queries use
+surveyColumns = [
+    'tripid',
+    'legid',
+    'traveldate',
+    'traveldate_dow',
+    'num_transit_legs',
+    'transit_system',
+    'board_stop_id',
+    'board_stop_name',
+    'per_weight_wd_trips_rsadj'
+    ]
+
 # Progress bar printer
 def drawProgressBar(percent, barLen = 20):
     sys.stdout.write("\r")
@@ -13,22 +40,442 @@ def drawProgressBar(percent, barLen = 20):
     ))
     sys.stdout.flush()
 
-def getWeekdayBusToSubway(fp="", outputFolder="."):
+busSystems = [
+    'Local MTA/New York City Transit Bus',
+    'Express/SBS MTA/New York City Transit Bus'
+    ]
+subwaySystem = 'New York City Transit Subway'
+
+def getWeekdayLegs(df):
     """
-    Function to query MTA 2018 Travel Survey (Unlinked), return
-    new csv file with average weekday bus-subway transfers
+    Function to filter the survey to legs of trips with > 1
+    transit leg on weekdays, returns the legs and the list of
+    unique weekday travel dates (busiest first)
     """
-    print("Retrieving Dataset, Could Take a little While...")
-    surveyURL = r'https://new.mta.info/document/29061' if fp == "" else fp
-    df = pandas.read_excel(surveyURL)
-    print("Dataset Retreived!")
-    
     ## Get list of unique weekdays for records including > 1 transit leg
     baseQuery = "traveldate_dow not in ('Saturday','Sunday') &\
          num_transit_legs == num_transit_legs & num_transit_legs > 1"
     uniqueDays = list(
         df.query(baseQuery).value_counts("traveldate").keys()
         )
+    ## Keep trips on those days with > 1 transit leg
+    #### If there was only one leg than there wasn't a transfer
+    legs = df[
+        df["traveldate"].isin(uniqueDays) &
+        (df["num_transit_legs"] > 1)
+        ]
+    return legs, uniqueDays
+
+def linkConsecutiveLegs(legs):
+    """
+    Function to sort legs within each trip and add the system of
+    the leg directly before each one (from_system, empty if the
+    leg is the first of the trip or the leg before it is missing)
+    """
+    ## Sort legs within each trip, mergesort keeps ties in file order
+    legs = legs.assign(rowOrder=numpy.arange(len(legs)))
+    ordered = legs.sort_values(
+        ['traveldate', 'tripid', 'legid'], kind='mergesort'
+        )
+    day = ordered['traveldate'].to_numpy()
+    trip = ordered['tripid'].to_numpy()
+    legid = ordered['legid'].to_numpy()
+    system = ordered['transit_system'].to_numpy(dtype=object)
+
+    ## The previous row is the leg before if it's the same trip
+    ## and numbered one before it
+    follows = numpy.zeros(len(ordered), dtype=bool)
+    follows[1:] = (
+        (day[1:] == day[:-1]) &
+        (trip[1:] == trip[:-1]) &
+        (legid[1:] == legid[:-1] + 1)
+        )
+    fromSystem = numpy.full(len(ordered), None, dtype=object)
+    fromSystem[1:][follows[1:]] = system[:-1][follows[1:]]
+    return ordered.assign(from_system=fromSystem)
+
+def findBusToSubwayTransfers(legs, uniqueDays):
+    """
+    Function to find every subway leg that directly follows a bus
+    leg of the same trip, for all days at once. Returns the subway
+    legs in the same order the day by day, trip by trip search used
+    (days and trips by number of records), so sums come out the same
+    """
+    ordered = linkConsecutiveLegs(legs)
+    transfers = ordered[
+        ordered['from_system'].isin(busSystems) &
+        (ordered['transit_system'] == subwaySystem)
+        ]
+
+    ## Rank days and trips the way value_counts listed them before
+    dayRank = {d: i for i, d in enumerate(uniqueDays)}
+    tripRank = {}
+    for d, dayLegs in legs.groupby('traveldate', sort=False):
+        for i, t in enumerate(dayLegs.value_counts("tripid").keys()):
+            tripRank[(d, t)] = i
+    transfers = transfers.assign(
+        dayRank=transfers['traveldate'].map(dayRank).to_numpy(),
+        tripRank=[tripRank[k] for k in zip(transfers['traveldate'], transfers['tripid'])]
+        )
+    return transfers.sort_values(
+        ['dayRank', 'tripRank', 'rowOrder'], kind='mergesort'
+        )
+
+def summarizeTransfers(transfers):
+    """
+    Function to sum the transfer weights by boarding station,
+    returns [station_id, station_name, total] rows in the order
+    the stations first appear
+    """
+    ## per_weight_wd_trips_rsadj weights trips based on average
+    ## weekday trips, so sum all of them. bincount adds in row order,
+    ## first per station per day, then the days for each station
+    stationCodes, stations = pandas.factorize(
+        transfers['board_stop_id'], use_na_sentinel=False
+        )
+    dayCodes = transfers['dayRank'].to_numpy()
+    pairCodes, pairs = pandas.factorize(
+        pandas.MultiIndex.from_arrays([dayCodes, stationCodes])
+        )
+    dailyTotals = numpy.bincount(
+        pairCodes,
+        weights=transfers['per_weight_wd_trips_rsadj'].to_numpy(dtype=float),
+        minlength=len(pairs)
+        )
+    pairStations = pairs.get_level_values(1).to_numpy()
+    stationTotals = numpy.bincount(
+        pairStations, weights=dailyTotals, minlength=len(stations)
+        )
+    ## Station name from the first leg boarding there
+    firstLeg = numpy.unique(stationCodes, return_index=True)[1]
+    stationNames = transfers['board_stop_name'].to_numpy()[firstLeg]
+
+    return [
+        [stations[i], stationNames[i], stationTotals[i]]
+        for i in range(len(stations))
+        ]
+
+def dateKey(value):
+    """
+    Function to get a travel date as YYYY-MM-DD text, whether it
+    was read as a date or as text
+    """
+    try:
+        return pandas.Timestamp(value).strftime("%Y-%m-%d")
+    except (ValueError, TypeError):
+        return str(value)
+
+def dateKeys(values):
+    """
+    Function to get dateKey for a column of travel dates, only
+    converting each distinct date once
+    """
+    codes, uniques = pandas.factorize(values)
+    return numpy.array([dateKey(u) for u in uniques], dtype=object)[codes]
+
+def bootstrapTransfers(transfers, trips, replicates=1000, confidence=0.95, seed=None, blockSize=20000000):
+    """
+    Function to get bootstrap confidence intervals for the station
+    totals of summarizeTransfers, resampling whole trips (trips is
+    a MultiIndex of the (traveldate, tripid) of every trip that
+    could have had a transfer, the key linkConsecutiveLegs uses,
+    since trip ids repeat across days). Replicates are
+    drawn as a matrix of trip indices, counted per trip, and the
+    transfer weights summed per station with bincount, in blocks
+    of about blockSize draws. Returns low and high arrays in the
+    same station order as summarizeTransfers
+    """
+    rng = numpy.random.default_rng(seed)
+    tripCount = len(trips)
+    stationCodes, stations = pandas.factorize(
+        transfers['board_stop_id'], use_na_sentinel=False
+        )
+    stationCount = len(stations)
+    legTrips = trips.get_indexer(pandas.MultiIndex.from_arrays(
+        [transfers['traveldate'], transfers['tripid']]
+        ))
+    legWeights = transfers['per_weight_wd_trips_rsadj'].to_numpy(dtype=float)
+
+    estimates = numpy.zeros((replicates, stationCount))
+    block = max(1, min(replicates, blockSize // max(tripCount, 1)))
+    for start in range(0, replicates, block):
+        size = min(block, replicates - start)
+        ## size x tripCount matrix of resampled trips, then how many
+        ## times each trip was drawn in each replicate
+        draws = rng.integers(0, tripCount, size=(size, tripCount))
+        draws += numpy.arange(size)[:, None] * tripCount
+        tripDraws = numpy.bincount(
+            draws.ravel(), minlength=size * tripCount
+            ).reshape(size, tripCount)
+        ## Each transfer leg counts once per draw of its trip
+        legDraws = tripDraws[:, legTrips] * legWeights
+        cells = numpy.arange(size)[:, None] * stationCount + stationCodes
+        estimates[start:start + size] = numpy.bincount(
+            cells.ravel(), weights=legDraws.ravel(),
+            minlength=size * stationCount
+            ).reshape(size, stationCount)
+
+    tail = (1 - confidence) / 2 * 100
+    low, high = numpy.percentile(estimates, [tail, 100 - tail], axis=0)
+    return low, high
+
+def loadStationTotals(path):
+    """
+    Function to load the stored per-station transfer totals, an
+    empty store if the file doesn't exist yet. Stations are keyed
+    by station id, along with the travel dates already added from
+    each survey wave
+    """
+    totals = {'waves': {}, 'stations': {}}
+    if os.path.exists(path):
+        with open(path, encoding="UTF8") as f:
+            stored = json.load(f)
+        totals['waves'] = {
+            wave: set(dates) for wave, dates in stored['waves'].items()
+            }
+        for stationId, stationName, transfers, days in stored['stations']:
+            totals['stations'][stationId] = {
+                'station_name': stationName,
+                'transfers': transfers,
+                'days': days
+                }
+    return totals
+
+def saveStationTotals(totals, path):
+    """
+    Function to write the per-station transfer totals to a json file
+    """
+    stored = {
+        'waves': {
+            wave: sorted(dates) for wave, dates in totals['waves'].items()
+            },
+        'stations': [
+            [stationId, s['station_name'], s['transfers'], s['days']]
+            for stationId, s in totals['stations'].items()
+            ]
+        }
+    with open(path + ".tmp", 'w', encoding="UTF8") as f:
+        json.dump(stored, f)
+    os.replace(path + ".tmp", path)
+
+def getWaveKey(source):
+    """
+    Function to get the key a survey wave is stored under, the
+    full path of local files or the URL
+    """
+    return os.path.abspath(source) if os.path.exists(source) else source
+
+def addStationTotals(totals, transfers, travelDates, wave):
+    """
+    Function to add the transfers of new travel dates of a survey
+    wave to the per-station totals, along with the number of days
+    each station had transfers on. Dates already added from the
+    same wave are skipped (and listed), so adding a wave twice
+    doesn't count it twice, while another wave surveying the same
+    date is still added. Returns the number of new dates added
+    """
+    travelDates = set(dateKey(d) for d in travelDates)
+    waveDates = totals['waves'].setdefault(wave, set())
+    skipped = travelDates & waveDates
+    if skipped:
+        print("Skipping {} Travel Dates Already Added from {}: {}".format(
+            len(skipped), wave, ", ".join(sorted(skipped))
+            ))
+    newDates = travelDates - waveDates
+    dates = dateKeys(transfers['traveldate'])
+    isNew = numpy.isin(dates, list(newDates))
+    ## One row per station per day, then one per station, keeping
+    ## legs without a stop id together like summarizeTransfers does
+    daily = transfers[isNew].assign(traveldate=dates[isNew]).groupby(
+        ['board_stop_id', 'traveldate'], sort=False, dropna=False
+        ).agg(
+            station_name=('board_stop_name', 'first'),
+            transfers=('per_weight_wd_trips_rsadj', 'sum')
+        )
+    byStation = daily.groupby(level=0, sort=False, dropna=False).agg(
+        station_name=('station_name', 'first'),
+        transfers=('transfers', 'sum'),
+        days=('transfers', 'size')
+        )
+    stations = totals['stations']
+    for stationId, stationName, stationTransfers, days in byStation.itertuples():
+        ## json only keeps text keys, so store numbers the same way,
+        ## and a missing stop id as None (NaN never equals itself)
+        stationId = stationId.item() if hasattr(stationId, 'item') else stationId
+        stationId = None if pandas.isna(stationId) else stationId
+        if stationId in stations:
+            stations[stationId]['transfers'] += float(stationTransfers)
+            stations[stationId]['days'] += int(days)
+        else:
+            stations[stationId] = {
+                'station_name': stationName,
+                'transfers': float(stationTransfers),
+                'days': int(days)
+                }
+    waveDates.update(newDates)
+    return len(newDates)
+
+def getSourceVersion(source):
+    """
+    Function to get a string that changes whenever the survey
+    source changes, file modified time and size for local files,
+    ETag or Last-Modified headers for URLs (None if offline)
+    """
+    if os.path.exists(source):
+        stat = os.stat(source)
+        return "{}-{}".format(stat.st_mtime_ns, stat.st_size)
+    try:
+        request = urllib.request.Request(source, method="HEAD")
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return "{}-{}-{}".format(
+                response.headers.get("ETag", ""),
+                response.headers.get("Last-Modified", ""),
+                response.headers.get("Content-Length", "")
+                )
+    except OSError:
+        return None
+
+def cacheSurvey(source, refresh=False, cacheFolder=cacheFolder):
+    """
+    Function to get the path of the cached Parquet copy of the
+    survey, keyed by the source path or URL and its version. The
+    copy is rebuilt from the Excel file when the source changes
+    or refresh is set
+    """
+    sourceKey = hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+    version = getSourceVersion(source)
+    cached = [
+        f for f in os.listdir(cacheFolder) if f.startswith(sourceKey + "_")
+        ] if os.path.isdir(cacheFolder) else []
+    if version is None:
+        ## Can't reach the source, so use whatever was cached last
+        cachePath = os.path.join(cacheFolder, cached[0]) if cached else None
+    else:
+        versionKey = hashlib.sha1(version.encode("utf-8")).hexdigest()[:16]
+        cachePath = os.path.join(cacheFolder, "{}_{}.parquet".format(sourceKey, versionKey))
+
+    if cachePath is None or refresh or not os.path.exists(cachePath):
+        if cachePath is None:
+            cachePath = os.path.join(cacheFolder, "{}_offline.parquet".format(sourceKey))
+        print("Retrieving Dataset, Could Take a little While...")
+        df = pandas.read_excel(source)
+        ## Parquet needs one type per column, so store mixed columns as text
+        for column in df.columns[df.dtypes == object]:
+            if pandas.api.types.infer_dtype(df[column], skipna=True) != "string":
+                df[column] = df[column].map(lambda v: v if pandas.isna(v) else str(v))
+        os.makedirs(cacheFolder, exist_ok=True)
+        df.to_parquet(cachePath + ".tmp", index=False)
+        os.replace(cachePath + ".tmp", cachePath)
+        ## Drop copies of older versions of this source
+        for f in cached:
+            if os.path.join(cacheFolder, f) != cachePath:
+                os.remove(os.path.join(cacheFolder, f))
+    else:
+        print("Reading Cached Dataset...")
+    return cachePath
+
+def loadSurvey(source, columns=None, refresh=False, cacheFolder=cacheFolder):
+    """
+    Function to load the survey from a cached Parquet copy, only
+    reading the given columns
+    """
+    if importlib.util.find_spec("pyarrow") is None:
+        print("pyarrow not installed, reading Excel file without cache")
+        return pandas.read_excel(source, usecols=columns)
+    return pandas.read_parquet(
+        cacheSurvey(source, refresh, cacheFolder), columns=columns
+        )
+
+def iterSurveyChunks(source, chunkSize=250000, refresh=False):
+    """
+    Function to read the survey columns the transfer queries use
+    in chunks of about chunkSize legs, with text columns as
+    categoricals. Legs of the last trip (traveldate, tripid) in a
+    chunk are held back for the next one, so every chunk has whole
+    trips. That needs the survey to list each trip's legs together,
+    so a ValueError is raised if a trip already handed out turns
+    up again (sort the file by traveldate and tripid first)
+    """
+    categories = [
+        'traveldate_dow',
+        'transit_system',
+        'board_stop_name'
+        ]
+    if source.lower().endswith(".csv"):
+        totalRows = None
+        batches = pandas.read_csv(
+            source,
+            usecols=surveyColumns,
+            dtype={c: 'category' for c in categories},
+            chunksize=chunkSize
+            )
+    else:
+        import pyarrow.parquet
+        ## Excel can't be read in pieces, so stream from the Parquet copy
+        path = source if source.lower().endswith(".parquet") else cacheSurvey(source, refresh)
+        parquetFile = pyarrow.parquet.ParquetFile(path, read_dictionary=categories)
+        totalRows = parquetFile.metadata.num_rows
+        batches = (
+            batch.to_pandas() for batch in
+            parquetFile.iter_batches(batch_size=chunkSize, columns=surveyColumns)
+            )
+
+    heldBack = None
+    rowsRead = 0
+    ## Sorted hashes of the trips handed out so far, 8 bytes a trip
+    yielded = numpy.array([], dtype=numpy.uint64)
+
+    def checkTrips(keys):
+        nonlocal yielded
+        keys = numpy.unique(keys)
+        if numpy.isin(keys, yielded, assume_unique=True).any():
+            raise ValueError(
+                "Legs of a trip in {} are split up (after row {}), sort "
+                "it by traveldate and tripid to stream it".format(source, rowsRead)
+                )
+        yielded = numpy.union1d(yielded, keys)
+
+    for chunk in batches:
+        rowsRead += len(chunk)
+        if totalRows:
+            drawProgressBar(rowsRead / totalRows)
+        if heldBack is not None:
+            chunk = pandas.concat([heldBack, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+        keys = pandas.util.hash_pandas_object(
+            chunk[['traveldate', 'tripid']], index=False
+            ).to_numpy()
+        lastTrip = keys == keys[-1]
+        heldBack = chunk[lastTrip]
+        checkTrips(keys[~lastTrip])
+        yield chunk[~lastTrip]
+    if heldBack is not None and len(heldBack) > 0:
+        checkTrips(keys[-1:])
+        yield heldBack
+
+def writeCsv(path, headers, rows):
+    """
+    Function to write the result rows to a new csv file
+    """
+    print("Printing Result to CSV file...")
+    with open(path, 'w', encoding="UTF8", newline='') as f:
+        writer = csv.writer(f, dialect="excel")
+        writer.writerow(headers)
+        writer.writerows(rows)
+    print(f"Done!\nOutput at {path}")
+
+def getWeekdayBusToSubway(fp="", outputFolder=".", refresh=False, bootstrap=0, confidence=0.95, seed=None):
+    """
+    Function to query MTA 2018 Travel Survey (Unlinked), return
+    new csv file with average weekday bus-subway transfers. With
+    bootstrap replicates, adds confidence interval columns
+    """
+    source = surveyURL if fp == "" else fp
+    df = loadSurvey(source, columns=surveyColumns, refresh=refresh)
+    print("Dataset Retreived!")
+
+    legs, uniqueDays = getWeekdayLegs(df)
     print("Found {} Unique Weekday Travel Dates".format(len(uniqueDays)))
 
     outputHeaders = [
@@ -36,120 +483,287 @@ def getWeekdayBusToSubway(fp="", outputFolder="."):
         'station_name',
         'transfers_bustosw_averagewd'
         ]
-    ## data including transfers per stop by day
-    rawResults = []
-    ## Store a list of all the stationids so we can summarize afterwards
-    allStopIds = []
-    ## Store weekday averages calculated for each stop in rawresults
-    finalResults = []
-
-    print("Iterating Through Ridership Data...")
-    for day in uniqueDays:
-        ## Object to store station info for each day
-        byStationResults = {}
-
-        ## Filter main dataset for trips on this day with > 1 transit leg
-        #### If there was only one leg than there wasn't a transfer
-        dayQuery = df.query(
-            "traveldate == @day &\
-            num_transit_legs == num_transit_legs & num_transit_legs > 1"
-            )
-        
-        ## Get list of tripids, to check each one for a bus transfer
-        dayTrips = list(dayQuery.value_counts("tripid").keys())
-        for trip in dayTrips:
-            ## Query all legs of the trip
-            dtq = dayQuery.query("tripid == @trip")
-            
-            ## Generate list of "legids" for all subway legs of the trip
-            subwayTrips = list(
-                dtq.query(
-                    "transit_system == 'New York City Transit Subway'"
-                    ).value_counts("legid").keys()
-                )
-            ## Generate list of legids for all bus legs of the trip
-            busTrips = list(
-                dtq.query(
-                    "transit_system in [\
-                        'Local MTA/New York City Transit Bus',\
-                        'Express/SBS MTA/New York City Transit Bus'\
-                    ]").value_counts("legid").keys()
-                )
-            
-            ## Filter bus legids for ones directly before a subway leg
-            busBeforeSubway = list(
-                filter(lambda el: int(el + 1) in subwayTrips, busTrips)
-                )
-            ## Now we know the bus legs directly preceding subway legs,
-            ## so add one to each, to list subway legids for each transfer 
-            subwayPostBusTrips = list(
-                map(lambda el: el + 1, busBeforeSubway)
-                )
-            
-            ## Query all the subway legs that occur right after bus legs
-            finalQuery = dtq.query("legid in @subwayPostBusTrips").filter(
-                    items=[
-                        'board_stop_id',
-                        'board_stop_name',
-                        'per_weight_wd_trips_rsadj'
-                        ]
-                    )
-            
-            ## Summarize trip data for each stop in byStationResults object
-            ## per_weight_wd_trips_rsadj weights trips based on average
-            ## weekday trips, so sum all of them
-            for label,trip in finalQuery.iterrows():
-                bsID = trip['board_stop_id']
-                bsName = trip["board_stop_name"]
-                tripWeight = trip['per_weight_wd_trips_rsadj']
-                if trip["board_stop_id"] in byStationResults:
-                    byStationResults[bsID]['trips'] += tripWeight
-                else:
-                    byStationResults[bsID] = {
-                        'board_stop_name': bsName,
-                        'trips': tripWeight
-                    }
-        ## Now let's write each day's trip data to the rawResults object
-        for stopId in byStationResults.keys():
-            if stopId not in allStopIds:
-                allStopIds.append(stopId)
-            rawResults.append([
-                stopId,
-                byStationResults[stopId]['board_stop_name'],
-                day,
-                byStationResults[stopId]['trips']
-            ])
-        
-        drawProgressBar(uniqueDays.index(day)/len(uniqueDays))
-    
-    print("\nRidersip Data Collected, Summarizing Averages per Stop")
-    for stop in allStopIds:
-        ## Filter Daily Totals in rawResults Object
-        filteredData = list(
-            filter(lambda el: el[0] == stop, rawResults)
+
+    print("Finding Bus to Subway Transfers...")
+    transfers = findBusToSubwayTransfers(legs, uniqueDays)
+
+    print("Ridersip Data Collected, Summarizing Averages per Stop")
+    finalResults = summarizeTransfers(transfers)
+
+    if bootstrap > 0:
+        print("Bootstrapping {} Replicates...".format(bootstrap))
+        ## Resample from every weekday trip, not only ones with transfers
+        weekdayTrips = pandas.MultiIndex.from_frame(df.loc[
+            ~df['traveldate_dow'].isin(['Saturday', 'Sunday']),
+            ['traveldate', 'tripid']
+            ]).unique()
+        low, high = bootstrapTransfers(
+            transfers, weekdayTrips, bootstrap, confidence, seed
             )
-        stopName = "" if len(filteredData) < 1 else filteredData[0][1]
-        
-        ## Calculate average ridership
-        stopAverage = sum(
-            map(lambda el: el[3], filteredData)
-            ) if len(filteredData) > 0 else 0
-        
-        ## Add row to the final results
-        finalResults.append([stop, stopName, stopAverage])
+        level = int(round(confidence * 100))
+        outputHeaders += [
+            f'transfers_bustosw_ci{level}_low',
+            f'transfers_bustosw_ci{level}_high'
+            ]
+        finalResults = [
+            row + [low[i], high[i]] for i, row in enumerate(finalResults)
+            ]
 
-    print("Printing Result to CSV file...")
-    with open(
+    writeCsv(
         f'{outputFolder}/BusTransfersPerStation_2018.csv',
-        'w',
-        encoding="UTF8",
-        newline=''
-        ) as f:
-        writer = csv.writer(f, dialect="excel")
-        writer.writerow(outputHeaders)
-        writer.writerows(finalResults)
-    print(
-        f"Done!\nOutput at {outputFolder}/BusTransfersPerStation_2018.csv"
+        outputHeaders, finalResults
+        )
+
+def getTransferMatrix(legs, systemGroups=None):
+    """
+    Function to sum the weighted transfers between every pair of
+    systems (from_system to to_system) by the station the second
+    leg boards at. systemGroups can map transit_system names to
+    broader groups, e.g. both NYCT bus systems to 'Bus'
+    """
+    ordered = linkConsecutiveLegs(legs)
+    transfers = ordered[ordered['from_system'].notna()]
+    fromSystem = transfers['from_system']
+    toSystem = transfers['transit_system']
+    if systemGroups is not None:
+        fromSystem = fromSystem.map(lambda v: systemGroups.get(v, v))
+        toSystem = toSystem.map(lambda v: systemGroups.get(v, v))
+    transfers = pandas.DataFrame({
+        'from_system': fromSystem.to_numpy(),
+        'to_system': toSystem.to_numpy(),
+        'station_id': transfers['board_stop_id'].to_numpy(),
+        'station_name': transfers['board_stop_name'].to_numpy(),
+        'transfers': transfers['per_weight_wd_trips_rsadj'].to_numpy(dtype=float)
+        })
+    return transfers.groupby(
+        ['from_system', 'to_system', 'station_id'], sort=True, dropna=False
+        ).agg(
+            station_name=('station_name', 'first'),
+            transfers=('transfers', 'sum')
+        ).reset_index()
+
+def pivotTransferMatrix(matrix):
+    """
+    Function to turn the long transfer table into one row per
+    station and one column per "from > to" system pair. Legs
+    without a station id keep their own row (pivot_table would
+    drop them), so the table adds up to the long one
+    """
+    pairs = matrix['from_system'] + ' > ' + matrix['to_system']
+    return matrix.assign(pair=pairs).groupby(
+        ['station_id', 'station_name', 'pair'], sort=True, dropna=False
+        )['transfers'].sum().unstack('pair', fill_value=0)
+
+def getWeekdayTransferMatrix(fp="", outputFolder=".", refresh=False, systemGroups=None, pivot=False):
+    """
+    Function to query MTA 2018 Travel Survey (Unlinked), return
+    new csv file with average weekday transfers between every pair
+    of systems per station (and a station by pair table if pivot)
+    """
+    source = surveyURL if fp == "" else fp
+    df = loadSurvey(source, columns=surveyColumns, refresh=refresh)
+    print("Dataset Retreived!")
+
+    legs, uniqueDays = getWeekdayLegs(df)
+    print("Found {} Unique Weekday Travel Dates".format(len(uniqueDays)))
+
+    print("Summarizing Transfers Between Systems...")
+    matrix = getTransferMatrix(legs, systemGroups)
+    writeTransferMatrix(matrix, outputFolder, pivot)
+    return matrix
+
+def writeTransferMatrix(matrix, outputFolder=".", pivot=False):
+    """
+    Function to write the transfer matrix to a csv file (and the
+    station by pair table if pivot)
+    """
+    matrix.to_csv(
+        f'{outputFolder}/TransfersBySystemPair_2018.csv',
+        index=False,
+        encoding="UTF8"
+        )
+    print(f"Output at {outputFolder}/TransfersBySystemPair_2018.csv")
+    if pivot:
+        pivotTransferMatrix(matrix).to_csv(
+            f'{outputFolder}/TransfersBySystemPairPivot_2018.csv',
+            encoding="UTF8"
+            )
+        print(f"Output at {outputFolder}/TransfersBySystemPairPivot_2018.csv")
+    print("Done!")
+
+def streamTransferTotals(sources, chunkSize=250000, refresh=False, totals=None, systemGroups=None):
+    """
+    Function to sum weekday transfers between every pair of
+    systems per boarding station over one or more survey waves,
+    reading each one in chunks of whole trips so memory stays flat.
+    Returns a dict keyed by (from_system, to_system, station_id)
+    of [station_name, transfers], adding to totals if given. A
+    missing station id is keyed as None, since NaN never equals
+    itself
+    """
+    totals = {} if totals is None else totals
+    for source in sources:
+        print("Reading {}...".format(source))
+        for chunk in iterSurveyChunks(source, chunkSize, refresh):
+            legs = chunk[
+                ~chunk['traveldate_dow'].isin(['Saturday', 'Sunday']) &
+                (chunk['num_transit_legs'] > 1)
+                ]
+            matrix = getTransferMatrix(legs, systemGroups)
+            for fromSystem, toSystem, stationId, stationName, transfers in matrix.itertuples(index=False):
+                key = (fromSystem, toSystem, None if pandas.isna(stationId) else stationId)
+                if key in totals:
+                    totals[key][1] += transfers
+                else:
+                    totals[key] = [stationName, transfers]
+        print()
+    return totals
+
+def getWeekdayBusToSubwayStreaming(sources, outputFolder=".", chunkSize=250000, refresh=False):
+    """
+    Function to get average weekday bus-subway transfers per
+    station for one or more survey waves (Excel, Parquet or CSV)
+    in bounded memory. Same columns and totals as
+    getWeekdayBusToSubway, but the rows are in station id order,
+    since the order that one lists stations in depends on every
+    day's legs at once
+    """
+    totals = streamTransferTotals(sources, chunkSize, refresh)
+    byStation = {}
+    for (fromSystem, toSystem, stationId), (stationName, transfers) in totals.items():
+        if fromSystem in busSystems and toSystem == subwaySystem:
+            if stationId in byStation:
+                byStation[stationId][2] += transfers
+            else:
+                byStation[stationId] = [stationId, stationName, transfers]
+    ## Missing station ids last, like the groupby in getTransferMatrix
+    rows = sorted(
+        byStation.values(), key=lambda row: (row[0] is None, 0 if row[0] is None else row[0])
+        )
+
+    writeCsv(f'{outputFolder}/BusTransfersPerStation_2018.csv', [
+        'station_id',
+        'station_name',
+        'transfers_bustosw_averagewd'
+        ], rows)
+
+def getWeekdayTransferMatrixStreaming(sources, outputFolder=".", chunkSize=250000, refresh=False, systemGroups=None, pivot=False):
+    """
+    Function to get average weekday transfers between every pair
+    of systems per station for one or more survey waves in bounded
+    memory, same output and row order as getWeekdayTransferMatrix
+    """
+    totals = streamTransferTotals(sources, chunkSize, refresh, systemGroups=systemGroups)
+    matrix = pandas.DataFrame(
+        [key + tuple(value) for key, value in totals.items()],
+        columns=['from_system', 'to_system', 'station_id', 'station_name', 'transfers']
         )
+    matrix = matrix.sort_values(
+        ['from_system', 'to_system', 'station_id'], kind='mergesort'
+        ).reset_index(drop=True)
+    writeTransferMatrix(matrix, outputFolder, pivot)
+    return matrix
 
-getWeekdayBusToSubway()
+def updateBusToSubwayTotals(fp="", totalsPath="BusTransfersTotals.json", outputFolder=".", refresh=False):
+    """
+    Function to add the weekday bus-subway transfers of travel
+    dates not seen before in this survey wave to the stored
+    per-station totals, return new csv file with totals, days and
+    average transfers per day
+    """
+    source = surveyURL if fp == "" else fp
+    df = loadSurvey(source, columns=surveyColumns, refresh=refresh)
+    print("Dataset Retreived!")
+
+    legs, uniqueDays = getWeekdayLegs(df)
+    totals = loadStationTotals(totalsPath)
+    wave = getWaveKey(source)
+    newDays = set(dateKey(d) for d in uniqueDays) - totals['waves'].get(wave, set())
+    print("Found {} New Weekday Travel Dates".format(len(newDays)))
+    newLegs = legs[numpy.isin(dateKeys(legs['traveldate']), list(newDays))]
+    if addStationTotals(totals, findBusToSubwayTransfers(newLegs, uniqueDays), uniqueDays, wave):
+        saveStationTotals(totals, totalsPath)
+
+    surveyDays = sum(len(dates) for dates in totals['waves'].values())
+    writeCsv(f'{outputFolder}/BusTransfersPerStationTotals.csv', [
+        'station_id',
+        'station_name',
+        'transfers_bustosw_total',
+        'days_with_transfers',
+        'survey_days',
+        'transfers_bustosw_perday'
+        ], [
+        [
+            stationId,
+            station['station_name'],
+            station['transfers'],
+            station['days'],
+            surveyDays,
+            station['transfers'] / surveyDays
+            ]
+        for stationId, station in totals['stations'].items()
+        ])
+    return totals
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Average weekday bus to subway transfers per station"
+        )
+    parser.add_argument(
+        "fp", nargs="*", default=[""],
+        help="survey file or URL, more than one with --stream for several waves"
+        )
+    parser.add_argument("--output", default=".", help="output folder")
+    parser.add_argument(
+        "--refresh", action="store_true",
+        help="download and parse the survey again instead of using the cache"
+        )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="read the survey in chunks of whole trips to keep memory flat"
+        )
+    parser.add_argument(
+        "--matrix", action="store_true",
+        help="transfers between every pair of systems instead of bus to subway"
+        )
+    parser.add_argument(
+        "--pivot", action="store_true",
+        help="with --matrix, also write a station by system pair table"
+        )
+    parser.add_argument(
+        "--totals",
+        help="json file of stored per-station totals to add new travel dates to"
+        )
+    parser.add_argument(
+        "--bootstrap", type=int, default=0,
+        help="number of bootstrap replicates for confidence intervals"
+        )
+    parser.add_argument(
+        "--confidence", type=float, default=0.95,
+        help="confidence level of the bootstrap intervals"
+        )
+    args = parser.parse_args()
+    ## Only the in-memory bus to subway output has interval columns
+    if args.bootstrap and (args.stream or args.matrix or args.totals):
+        parser.error("--bootstrap can't be used with --stream, --matrix or --totals")
+    if args.totals:
+        for fp in args.fp:
+            updateBusToSubwayTotals(fp, args.totals, args.output, args.refresh)
+    elif args.stream:
+        sources = [
+            surveyURL if fp == "" else fp
+            for fp in args.fp
+            ]
+        if args.matrix:
+            getWeekdayTransferMatrixStreaming(
+                sources, args.output, refresh=args.refresh, pivot=args.pivot
+                )
+        else:
+            getWeekdayBusToSubwayStreaming(sources, args.output, refresh=args.refresh)
+    elif args.matrix:
+        getWeekdayTransferMatrix(args.fp[0], args.output, args.refresh, pivot=args.pivot)
+    else:
+        getWeekdayBusToSubway(
+            args.fp[0], args.output, args.refresh,
+            args.bootstrap, args.confidence
+            )
@@ -1,7 +1,28 @@
-import arcpy
+import argparse
+import collections
+import concurrent.futures
 import datetime
+import email.utils
+import functools
+import json
+import operator
+import os
+import queue
+import random
 import requests
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+import Util_FeatureSinks
+import Util_TextArrayTokenizer
+# arcpy is only needed to write the feature class, formatting works without it
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
 
 # Script to query an online database of board records
 # Then convert to usable geojson layer
@@ -74,12 +95,75 @@ headers = {
     'User-Agent': '',
     'Authorization': ''
 }
-skipCounter = 0
-fullResponse = []
-blocklotlist = []
-parcelInfoList = []
-def makeReq(skip):
-    fieldIDs = [field[0] for field in fields]
+# Records per page to start with, number of pages fetched at the same time,
+# and number of fetched pages allowed to wait for the write stage
+pageSize = 4000
+maxWorkers = 4
+pageQueueSize = 4
+# Page size adapts to aim for pages of about this many seconds and bytes, within these limits
+minPageSize = 250
+maxPageSize = 10000
+targetPageSeconds = 5
+targetPageBytes = 8000000
+# Quickbase API (point at a local stub server for testing), request timeout in seconds,
+# and retries of a page on a timeout, throttling (429) or server error
+apiUrl = 'https://api.quickbase.com'
+requestTimeout = 120
+maxRetries = 6
+retryStatuses = (429, 500, 502, 503, 504)
+# One session shares keep-alive connections between all the page requests
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxWorkers))
+session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxWorkers))
+# Local store of formatted records, and the feature class kept up to date, for incremental syncs
+recordStore = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Quickbase_PZO_Applications.sqlite"
+syncFeatureClass = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb/Quickbase_PZO_Applications"
+# Pages fetched so far by a full query, so a run that crashes picks up where it stopped
+pageCheckpoint = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Quickbase_PZO_Checkpoint.sqlite"
+# Quickbase built-in Date Modified field
+dateModifiedField = "2"
+
+class PageSizer:
+    # Page size shared by the fetch threads, grown or shrunk from how long each page took and how big it was
+    def __init__(self, size=pageSize, minimum=minPageSize, maximum=maxPageSize):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.lock = threading.Lock()
+
+    def observe(self, skip, top, page, seconds, numBytes):
+        received = page['metadata']['numRecords']
+        if received == 0:
+            return
+        with self.lock:
+            # Quickbase sent fewer than asked for before the end, so that's as big as pages get
+            if received < top and skip + received < int(page['metadata']['totalRecords']):
+                self.maximum = max(self.minimum, received)
+            # At most double or halve at a time, so one slow page doesn't swing it too far
+            scale = min(targetPageSeconds / max(seconds, 0.001), targetPageBytes / max(numBytes, 1))
+            scale = min(2.0, max(0.5, scale))
+            self.size = int(min(self.maximum, max(self.minimum, received * scale)))
+
+# Time before which no request is sent, pushed back whenever Quickbase throttles us, so every thread waits
+throttle = {"until": 0.0}
+throttleLock = threading.Lock()
+
+def getRetryDelay(response, attempt):
+    # Quickbase says how long to wait in Retry-After (seconds or a date), otherwise back off exponentially
+    retryAfter = None if response is None else response.headers.get("Retry-After")
+    if retryAfter:
+        try:
+            return max(0.0, float(retryAfter))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(retryAfter)
+                return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return min(60.0, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def makeReq(skip, top=pageSize, select=None, where=None, sizer=None):
+    fieldIDs = [field[0] for field in fields] if select is None else select
     body = {
         "from": "bq8edipds",
         "select": fieldIDs,
@@ -87,20 +171,161 @@ def makeReq(skip):
             {
                 "fieldId": 9,
                 "order": 'ASC'
+            },
+            # Record ID breaks ties, so pages fetched at the same time don't overlap
+            {
+                "fieldId": 3,
+                "order": 'ASC'
             }
         ],
         "options": {
             "skip": skip,
-            "top": 4000
+            "top": top
         }
     }
-    r = requests.post(
-        'https://api.quickbase.com/v1/records/query', 
-        headers = headers,
-        json = body
-    )
-    return r
+    if where is not None:
+        body["where"] = where
+    for attempt in range(maxRetries + 1):
+        with throttleLock:
+            wait = throttle["until"] - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        start = time.perf_counter()
+        try:
+            r = session.post(
+                apiUrl + '/v1/records/query',
+                headers = headers,
+                json = body,
+                timeout = requestTimeout
+            )
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if attempt == maxRetries:
+                raise
+            reason, r = type(e).__name__, None
+        else:
+            if r.status_code not in retryStatuses or attempt == maxRetries:
+                r.raise_for_status()
+                # Parse the response once, callers use the returned dict
+                page = r.json()
+                if sizer is not None:
+                    sizer.observe(skip, top, page, time.perf_counter() - start, len(r.content))
+                return page
+            reason = "HTTP {}".format(r.status_code)
+        # Only this page is retried, the others carry on unless we're being throttled
+        delay = getRetryDelay(r, attempt)
+        if r is not None and r.status_code == 429:
+            with throttleLock:
+                throttle["until"] = max(throttle["until"], time.monotonic() + delay)
+        sys.stderr.write("\n{} on records {}-{}, retrying in {:.1f}s\n".format(reason, skip, skip + top, delay))
+        time.sleep(delay)
+
+def openCheckpoint(path=pageCheckpoint):
+    # Read from the fetch thread, so allow use outside the thread that opened it
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS pages (query TEXT, skip INTEGER, total INTEGER, numRecords INTEGER, data TEXT, PRIMARY KEY (query, skip))")
+    return conn
 
+def clearCheckpoint(checkpoint):
+    checkpoint.execute("DELETE FROM pages")
+    checkpoint.commit()
+
+def fetchAllPages(select=None, where=None, checkpoint=None):
+    query = json.dumps([select, where])
+    # Pages saved by an earlier run, only the unbroken run from the start counts
+    saved, skip = [], 0
+    if checkpoint is not None:
+        for row in checkpoint.execute("SELECT skip, total, numRecords, data FROM pages WHERE query = ? ORDER BY skip", (query,)):
+            if row[0] != skip:
+                break
+            saved.append(row)
+            skip += row[2]
+    sizer = PageSizer()
+    # First page fetched tells us the total, the rest are fetched concurrently
+    top = sizer.size
+    first = makeReq(skip, top, select, where, sizer)
+    total = int(first['metadata']['totalRecords'])
+    if saved and saved[0][1] != total:
+        # Records were added or removed since, so the saved offsets no longer line up
+        print("Record Count Changed, Starting Over...")
+        checkpoint.execute("DELETE FROM pages WHERE query = ?", (query,))
+        checkpoint.commit()
+        saved, skip = [], 0
+        top = sizer.size
+        first = makeReq(skip, top, select, where, sizer)
+        total = int(first['metadata']['totalRecords'])
+    if saved:
+        print("Resuming From Record {} of {}".format(skip, total))
+    for pageSkip, pageTotal, numRecords, data in saved:
+        yield {"data": json.loads(data), "metadata": {"totalRecords": pageTotal, "numRecords": numRecords, "skip": pageSkip}}
+
+    def done(pageSkip, page):
+        if checkpoint is not None:
+            checkpoint.execute("INSERT OR REPLACE INTO pages (query, skip, total, numRecords, data) VALUES (?, ?, ?, ?, ?)",
+                (query, pageSkip, total, page['metadata']['numRecords'], json.dumps(page['data'])))
+            checkpoint.commit()
+        return page
+
+    nextSkip = skip + top
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        # (skip, top, future, attempt) of each request, handed back in skip order whatever order they arrive in
+        pending = collections.deque([(skip, top, None, 0)])
+        while pending:
+            pageSkip, pageTop, future, attempt = pending.popleft()
+            page = first if future is None else future.result()
+            received = page['metadata']['numRecords']
+            # An empty page short of the total would leave a gap, so ask again and give up if it stays empty
+            if received == 0 and pageSkip < total:
+                if attempt == maxRetries:
+                    raise RuntimeError("Quickbase returned no records from {} of {} after {} tries".format(
+                        pageSkip, total, attempt + 1))
+                delay = getRetryDelay(None, attempt)
+                sys.stderr.write("\nNo records from {} of {}, retrying in {:.1f}s\n".format(pageSkip, total, delay))
+                time.sleep(delay)
+                pending.appendleft((pageSkip, pageTop,
+                    executor.submit(makeReq, pageSkip, pageTop, select, where, sizer), attempt + 1))
+                continue
+            # Quickbase can return fewer records than asked for, so ask again for the rest before moving on
+            if received < pageTop and pageSkip + received < total:
+                rest = pageSkip + received
+                pending.appendleft((rest, pageSkip + pageTop - rest,
+                    executor.submit(makeReq, rest, pageSkip + pageTop - rest, select, where, sizer), 0))
+            # Keep maxWorkers requests in flight, each sized by the latest pages
+            while len(pending) < maxWorkers and nextSkip < total:
+                top = sizer.size
+                pending.append((nextSkip, top, executor.submit(makeReq, nextSkip, top, select, where, sizer), 0))
+                nextSkip += top
+            yield done(pageSkip, page)
+
+def queuePages(pages, maxsize=pageQueueSize):
+    # Fetch pages in a background thread, handing them over through a bounded queue
+    # so the network keeps going while pages are written, without piling up in memory
+    pageQueue = queue.Queue(maxsize)
+    done = object()
+    def fetch():
+        try:
+            for page in pages:
+                pageQueue.put(page)
+        except BaseException as e:
+            pageQueue.put(e)
+        else:
+            pageQueue.put(done)
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    while True:
+        page = pageQueue.get()
+        if page is done:
+            break
+        if isinstance(page, BaseException):
+            raise page
+        yield page
+    thread.join()
+
+def formatPages(pages):
+    # Yield the total record count and formatted records of each page
+    for page in pages:
+        yield int(page['metadata']['totalRecords']), formatPage(page['data'])
+
+# Per record formatting, checks every field's type on every record (kept as the baseline for benchmarkFormat)
 def formatResp(obj):
     newdata = []
     for f in fields:
@@ -124,21 +349,75 @@ def formatResp(obj):
     newdata.append(("Record_URL","https://cityofnewark.quickbase.com/db/bq8edipds?a=dr&rid={}".format(obj['3']["value"])))
     return dict(newdata)
 
-def makeBlockLotList(row):
-    return row['BlockLot_Primary']
+# Attachment and multi-select (list) fields, and longest text a feature class field holds
+attachmentFields = ("22","55","57","59","61","62","63","64","164","166")
+multiSelectFields = ("12","16","30","69","74","107","167","168","169","175")
+textLimit = 255
 
-def makeParcelList(row):
-    return { 'BlockLot': row.getValue('LOT_BLOCK_LOT'), 'SHAPE': row.getValue('SHAPE') }
+def attachmentUrl(value):
+    # Create link to quickbase attachment "https://cityofnewark.quickbase.com/up/{Table ID}/a/r{Record ID}/e{Field ID}/v{Version Number}"
+    if value["url"] == "":
+        return ""
+    urlArray = value["url"][1:].split("/")
+    return "https://cityofnewark.quickbase.com/up/{}/a/r{}/e{}/v{}".format(urlArray[1],urlArray[2],urlArray[3],urlArray[4])
 
-# Create an in_memory feature class
-feature_class = arcpy.CreateFeatureclass_management(
-    "in_memory", "Quickbase_PZO_Applications", "POLYGON", spatial_reference=3424)[0]
+@functools.lru_cache(maxsize=4096)
+def parseDate(value):
+    # Records share a lot of dates, so each one is only parsed once
+    return str(datetime.datetime.strptime(value, "%Y-%m-%d")) if value != '' else None
 
-# Convert fields object to an array of field names
-def makeFeatureFields():
-    fieldlist = [field[1] for field in fields]
-    fieldlist.append("Record_URL")
-    fieldlist.insert(0, "SHAPE@")
+def compileFormat(fields):
+    # Work out each field's converter once, instead of checking the field type on every value
+    plan = []
+    for field in fields:
+        if field[0] in attachmentFields:
+            convert = attachmentUrl
+        elif field[0] in multiSelectFields:
+            convert = ";".join
+        elif field[2] == 'DATE':
+            convert = parseDate
+        else:
+            convert = None
+        plan.append((field[0], field[1], convert))
+    return tuple(plan)
+
+formatPlan = compileFormat(fields)
+
+def formatPage(rows, plan=formatPlan):
+    # Format a whole page of records with the compiled plan, same output as formatResp
+    records = []
+    for obj in rows:
+        feat = {name: obj[fieldID]["value"] if convert is None else convert(obj[fieldID]["value"])
+            for fieldID, name, convert in plan}
+        feat["Record_URL"] = "https://cityofnewark.quickbase.com/db/bq8edipds?a=dr&rid={}".format(obj['3']["value"])
+        records.append(feat)
+    return records
+
+# Separator to normalize block/lot text to (e.g. "-" for the parcels' "12-3" LOT_BLOCK_LOT),
+# None matches the block-lots as written, like the toolbox's default
+blockLotSeparator = None
+
+def makeBlockLotList(row):
+    # Primary parcel first, then any others listed for the record (mixed delimiters, "Block 12 Lots 3-5" etc.),
+    # both normalized if a blockLotSeparator is set and each listed once
+    blocklots = []
+    if row['BlockLot_Primary']:
+        if blockLotSeparator is None:
+            blocklots.append(row['BlockLot_Primary'])
+        else:
+            blocklots.extend(Util_TextArrayTokenizer.tokenize(row['BlockLot_Primary'], separator=blockLotSeparator))
+    if row.get('BlockLot_List'):
+        blocklots.extend(Util_TextArrayTokenizer.tokenize(row['BlockLot_List'], separator=blockLotSeparator))
+    return list(dict.fromkeys(blocklots))
+
+# Output coordinate system, and the (name, type) of each output field for the sinks
+outputWkid = 3424
+outputSchema = [(field[1], field[2]) for field in fields] + [("Record_URL", "TEXT")]
+
+# Create a feature class (in_memory by default) with the fields object and record url
+def makeFeatureClass(workspace="in_memory", name="Quickbase_PZO_Applications"):
+    feature_class = arcpy.CreateFeatureclass_management(
+        workspace, name, "POLYGON", spatial_reference=outputWkid)[0]
     addField_Format = [[field[1],field[2],field[3]] for field in fields]
     addField_Format.append(["Record_URL", "TEXT", "Record URL"])
     # Add fields to feature class
@@ -146,11 +425,36 @@ def makeFeatureFields():
         feature_class,
         addField_Format
         )
+    return feature_class
+
+# Convert fields object to an array of field names
+def makeFeatureFields():
+    fieldlist = [field[1] for field in fields]
+    fieldlist.append("Record_URL")
+    fieldlist.insert(0, "SHAPE@")
     return fieldlist
 
 # Make feature fields with record url and shape
 feature_fields = makeFeatureFields()
 
+def compileRow(feature_fields):
+    # Pull a record's values in feature field order, cutting long text to fit, worked out once for every row
+    getValues = operator.itemgetter(*feature_fields[1:])
+    fieldTypes = dict((field[1], field[2]) for field in fields)
+    fieldTypes["Record_URL"] = "TEXT"
+    textColumns = tuple(i for i, name in enumerate(feature_fields[1:]) if fieldTypes[name] == "TEXT")
+    def makeRow(shape, feat):
+        row = list(getValues(feat))
+        for i in textColumns:
+            value = row[i]
+            if isinstance(value, str) and len(value) > textLimit:
+                row[i] = value[:textLimit - 1]
+        row.insert(0, shape)
+        return row
+    return makeRow
+
+makeRow = compileRow(feature_fields)
+
 # Progress bar printer during feature class creation
 def drawProgressBar(percent, barLen = 20):
     # percent float from 0 to 1. 
@@ -158,43 +462,353 @@ def drawProgressBar(percent, barLen = 20):
     sys.stdout.write("[{:<{}}] {:.0f}%".format("=" * int(barLen * percent), barLen, percent * 100))
     sys.stdout.flush()
 
-def doQuery():
-    global skipCounter
-    r = makeReq(skipCounter)
-    fullResponse.extend([formatResp(row) for row in r.json()['data']])
-    blocklotlist.extend([makeBlockLotList(row) for row in fullResponse])
-    
-    # Set the workspace
-    arcpy.env.workspace = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb"
-
-    # Set the parcel featureset
-    parcels = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb/Newark_Parcels_2020_07_31_AddLotFixed"
-    parcelsCursor = arcpy.SearchCursor(parcels, 'LOT_BLOCK_LOT in {} AND SHAPE IS NOT NULL'.format(str(tuple(blocklotlist))), ["LOT_BLOCK_LOT", "SHAPE@"])
-    parcelInfoList.extend([makeParcelList(row) for row in parcelsCursor])
-    print('Parcels Gathered, {} Parcels'.format(len(parcelInfoList)))
-    if (r.json()['metadata']['skip'] + r.json()['metadata']['top']) >= int(r.json()['metadata']['totalRecords']):
-        print("Print Done, Writing Features...")
-        # Open an insert cursor
-        with arcpy.da.InsertCursor(feature_class, tuple(feature_fields)) as cursor:
-            # Iterate through list of coordinates and add to cursor
-            for feat in fullResponse:
-                shape = None
-                if list(filter(lambda obj: obj['BlockLot'] == feat['BlockLot_Primary'], parcelInfoList)) != []:
-                    shape = list(filter(lambda obj: obj['BlockLot'] == feat['BlockLot_Primary'], parcelInfoList))[0]["SHAPE"]
+# Parcel featureset and number of block-lots per query, so the where clause stays a reasonable length
+parcels = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb/Newark_Parcels_2020_07_31_AddLotFixed"
+parcelChunkSize = 500
+# Local cache of parcel shapes (as WKB) by block-lot, so warm runs don't need the geodatabase
+parcelCache = "D:/Documents/ArcGIS/Projects/NewarkGeneral/ParcelCache.sqlite"
+
+def getDatasetVersion(dataset):
+    # Row count and extent of the parcel feature class itself, so edits to other datasets
+    # in the same geodatabase (like the synced applications) don't clear the cache
+    extent = arcpy.Describe(dataset).extent
+    return {
+        "path": dataset,
+        "rows": str(arcpy.management.GetCount(dataset)[0]),
+        "extent": "{} {} {} {}".format(extent.XMin, extent.YMin, extent.XMax, extent.YMax)
+    }
+
+def openParcelCache(path=parcelCache, dataset=parcels):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS parcels (blocklot TEXT PRIMARY KEY, wkb BLOB)")
+    conn.execute("CREATE TABLE IF NOT EXISTS cache_state (name TEXT PRIMARY KEY, value TEXT)")
+    state = dict(conn.execute("SELECT name, value FROM cache_state"))
+    version = getDatasetVersion(dataset)
+    if any(state.get(name) != value for name, value in version.items()):
+        print("Parcel Dataset Changed, Clearing Parcel Cache...")
+        conn.execute("DELETE FROM parcels")
+        conn.execute("DELETE FROM cache_state")
+        version["wkid"] = str(arcpy.Describe(dataset).spatialReference.factoryCode)
+        conn.executemany("INSERT INTO cache_state (name, value) VALUES (?, ?)", list(version.items()))
+        conn.commit()
+        state = version
+    return conn, state
+
+def readCachedParcels(blocklots, conn):
+    # Block-lots found in the cache, and the WKB of those with a shape (a block-lot with no parcel is cached with no shape)
+    cached, wkbIndex = set(), {}
+    for i in range(0, len(blocklots), parcelChunkSize):
+        chunk = blocklots[i:i + parcelChunkSize]
+        for blocklot, wkb in conn.execute(
+            "SELECT blocklot, wkb FROM parcels WHERE blocklot IN ({})".format(",".join("?" * len(chunk))), chunk):
+            cached.add(blocklot)
+            if wkb is not None:
+                wkbIndex[blocklot] = bytes(wkb)
+    return cached, wkbIndex
+
+def getParcels(blocklots, conn, state):
+    # Index parcel shapes by block-lot, each block-lot is only looked up once
+    parcelIndex = {}
+    blocklots = sorted(set(blocklots))
+    spatialReference = arcpy.SpatialReference(int(state["wkid"]))
+
+    # Cached block-lots first
+    cached, wkbIndex = readCachedParcels(blocklots, conn)
+    for blocklot, wkb in wkbIndex.items():
+        parcelIndex[blocklot] = arcpy.FromWKB(wkb, spatialReference)
+    misses = [bl for bl in blocklots if bl not in cached]
+
+    if misses:
+        # Set the workspace
+        arcpy.env.workspace = "D:/Documents/ArcGIS/Projects/NewarkGeneral/Default.gdb"
+        found = {}
+        for i in range(0, len(misses), parcelChunkSize):
+            # Quote each block-lot, doubling any quotes inside it
+            inList = ",".join("'{}'".format(bl.replace("'", "''")) for bl in misses[i:i + parcelChunkSize])
+            with arcpy.da.SearchCursor(parcels, ["LOT_BLOCK_LOT", "SHAPE@"], 'LOT_BLOCK_LOT IN ({}) AND SHAPE IS NOT NULL'.format(inList)) as parcelsCursor:
+                for blocklot, shape in parcelsCursor:
+                    found.setdefault(blocklot, shape)
+        parcelIndex.update(found)
+        conn.executemany(
+            "INSERT OR REPLACE INTO parcels (blocklot, wkb) VALUES (?, ?)",
+            [(bl, bytes(found[bl].WKB) if bl in found else None) for bl in misses])
+        conn.commit()
+    return parcelIndex
+
+def joinParcels(feat, parcelIndex):
+    # Merge the shapes of the primary and listed parcels found for the record
+    shape = None
+    for blocklot in makeBlockLotList(feat):
+        parcel = parcelIndex.get(blocklot)
+        if parcel is not None:
+            shape = parcel if shape is None else shape.union(parcel)
+    return shape
+
+def readParcelCacheState(path):
+    # Open a parcel cache built with arcpy, and the parcel dataset version it was built from
+    if not os.path.exists(path):
+        raise FileNotFoundError("No parcel cache at {}, run once with arcpy to build it".format(path))
+    conn = sqlite3.connect(path)
+    try:
+        state = dict(conn.execute("SELECT name, value FROM cache_state"))
+    except sqlite3.OperationalError:
+        state = {}
+    if not state:
+        conn.close()
+        raise ValueError("{} has no parcel cache state, run once with arcpy to build it".format(path))
+    return conn, state
+
+def joinPagesWkb(pages, path):
+    # Without arcpy only cached parcels can be joined, a record's parcels are collected into one multipolygon WKB
+    conn, state = readParcelCacheState(path)
+    # The parcel dataset can't be checked without arcpy, so say which version the shapes come from
+    print("Using Parcel Cache of {} ({} Rows, Extent {}), Not Checked Against The Dataset Without arcpy".format(
+        state.get("path"), state.get("rows"), state.get("extent")))
+    missing = set()
+    try:
+        for total, records in pages:
+            blocklots = sorted(set(bl for feat in records for bl in makeBlockLotList(feat)))
+            cached, wkbIndex = readCachedParcels(blocklots, conn)
+            missing.update(bl for bl in blocklots if bl not in cached)
+            yield total, [(Util_FeatureSinks.mergeWkb([wkbIndex.get(bl) for bl in makeBlockLotList(feat)]), feat) for feat in records]
+    finally:
+        conn.close()
+    if missing:
+        print("\n{} Block-Lots Not In The Parcel Cache, Run Once With arcpy To Add Them".format(len(missing)))
+
+def joinPages(pages):
+    # Look up the parcels of each page as it comes, yielding (shape, record) pairs
+    if arcpy is None:
+        yield from joinPagesWkb(pages, parcelCache)
+        return
+    conn, state = openParcelCache(parcelCache, parcels)
+    try:
+        for total, records in pages:
+            parcelIndex = getParcels((bl for feat in records for bl in makeBlockLotList(feat)), conn, state)
+            yield total, [(joinParcels(feat, parcelIndex), feat) for feat in records]
+    finally:
+        conn.close()
+
+def writeFeatures(sink, joined):
+    print("Writing Features...")
+    written = 0
+    # Write each page as soon as it's joined, in one batch
+    for total, rows in joined:
+        sink.write([makeRow(shape, feat) for shape, feat in rows])
+        written += len(rows)
+        # Progress once per page rather than once per row
+        drawProgressBar(written / total if total else 1)
+    print("\nFeature Class Set Up, {} Features.".format(written))
+
+def insertFeatures(feature_class, joined):
+    # Adds to the features already there, the sync deletes the ones it replaces first
+    with Util_FeatureSinks.ArcpySink(feature_class, outputSchema, outputWkid, append=True) as sink:
+        writeFeatures(sink, joined)
+
+def doQuery(output, checkpointPath=pageCheckpoint):
+    # fetch -> format -> join -> write, one page at a time
+    checkpoint = openCheckpoint(checkpointPath)
+    try:
+        with Util_FeatureSinks.makeSink(output, outputSchema, outputWkid) as sink:
+            writeFeatures(sink, joinPages(formatPages(queuePages(fetchAllPages(checkpoint=checkpoint)))))
+        # Everything's written, so the next run starts from the beginning
+        clearCheckpoint(checkpoint)
+    finally:
+        checkpoint.close()
+
+def openRecordStore(path=recordStore):
+    # Formatted records keyed by Record_ID, plus the sync high-water mark
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS records (Record_ID INTEGER PRIMARY KEY, Date_Modified TEXT, data TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+def getHighWaterMark(conn):
+    row = conn.execute("SELECT value FROM sync_state WHERE name = 'date_modified'").fetchone()
+    return None if row is None else row[0]
+
+def deleteFeatures(feature_class, recordIDs):
+    # Delete in chunks so the where clause stays a reasonable length
+    recordIDs = sorted(recordIDs)
+    for i in range(0, len(recordIDs), 500):
+        idList = ",".join(str(rid) for rid in recordIDs[i:i + 500])
+        with arcpy.da.UpdateCursor(feature_class, ["Record_ID"], "Record_ID IN ({})".format(idList)) as cursor:
+            for row in cursor:
+                cursor.deleteRow()
+
+def syncRecords(feature_class=syncFeatureClass, storePath=recordStore):
+    # Check before downloading anything, the features can only be updated with arcpy
+    if arcpy is None:
+        raise ImportError("arcpy is needed to sync a feature class, use a .geojsonl, .gpkg or .fgb --output instead")
+    conn = openRecordStore(storePath)
+    highWater = getHighWaterMark(conn)
+    # Only ask for records modified since the last sync (on or after, so nothing at the same instant is missed)
+    where = None if highWater is None else "{{{}.OAF.'{}'}}".format(dateModifiedField, highWater)
+    select = [field[0] for field in fields] + [dateModifiedField]
+    changed = []
+    newHighWater = highWater
+    for page in fetchAllPages(select, where):
+        for row, feat in zip(page['data'], formatPage(page['data'])):
+            modified = row[dateModifiedField]["value"]
+            changed.append(feat)
+            conn.execute(
+                "INSERT OR REPLACE INTO records (Record_ID, Date_Modified, data) VALUES (?, ?, ?)",
+                (feat['Record_ID'], modified, json.dumps(feat)))
+            if newHighWater is None or modified > newHighWater:
+                newHighWater = modified
+    print('{} Records Changed Since {}'.format(len(changed), highWater))
+
+    # Records deleted in Quickbase don't show up as modified, so compare the list of Record_IDs
+    liveIDs = set(row["3"]["value"] for page in fetchAllPages(["3"]) for row in page['data'])
+    deletedIDs = set(r[0] for r in conn.execute("SELECT Record_ID FROM records")) - liveIDs
+    conn.executemany("DELETE FROM records WHERE Record_ID = ?", [(rid,) for rid in deletedIDs])
+    print('{} Records Deleted'.format(len(deletedIDs)))
+
+    if not arcpy.Exists(feature_class):
+        # First sync, so build the feature class from everything in the store
+        makeFeatureClass(os.path.dirname(feature_class), os.path.basename(feature_class))
+        total = conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        stored = conn.execute("SELECT data FROM records")
+        pages = iter(lambda: stored.fetchmany(pageSize), [])
+        insertFeatures(feature_class, joinPages((total, [json.loads(r[0]) for r in page]) for page in pages))
+    else:
+        # Replace only the features of changed or deleted records
+        deleteFeatures(feature_class, set(feat['Record_ID'] for feat in changed) | deletedIDs)
+        if changed:
+            insertFeatures(feature_class, joinPages([(len(changed), changed)]))
+
+    # Save the store and high-water mark only once the features are updated, so a failed run syncs again
+    if newHighWater is not None:
+        conn.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('date_modified', ?)", (newHighWater,))
+    conn.commit()
+    conn.close()
+
+def makeSampleRecord(recordID):
+    # Made up record shaped like a Quickbase response row, for benchmarks without the live database
+    row = {}
+    for field in fields:
+        if field[0] == "3":
+            value = recordID
+        elif field[0] in attachmentFields:
+            value = {"url": "/files/bq8edipds/{}/{}/0".format(recordID, field[0]) if recordID % 3 else ""}
+        elif field[0] in multiSelectFields:
+            value = ["Option {}".format(i) for i in range(recordID % 3)]
+        elif field[2] == 'DATE':
+            value = "2020-{:02d}-{:02d}".format(recordID % 12 + 1, recordID % 28 + 1) if recordID % 5 else ""
+        elif field[2] == 'SHORT':
+            value = recordID % 100
+        elif field[2] == 'FLOAT':
+            value = float(recordID % 10000)
+        elif field[1] == 'BlockLot_Primary':
+            value = "{}-{}".format(recordID % 5000 + 1, recordID % 40 + 1)
+        elif field[1] == 'BlockLot_List':
+            # Every fourth record covers two more lots on the same block
+            value = "{0}-{1}, {0}-{2}".format(recordID % 5000 + 1, recordID % 40 + 2, recordID % 40 + 3) if recordID % 4 == 0 else ""
+        elif field[1] in ('Summary_Project', 'Summary_Notes'):
+            value = "Notes for record {}. ".format(recordID) * (recordID % 20)
+        else:
+            value = "{} {}".format(field[3], recordID)
+        row[field[0]] = {"value": value}
+    return row
+
+def benchmarkFormat(numRecords=20000, pageSize=pageSize):
+    # Records per second formatted and made into insert rows, per record checks vs the compiled plans
+    rows = [makeSampleRecord(i) for i in range(1, numRecords + 1)]
+    pages = [rows[i:i + pageSize] for i in range(0, numRecords, pageSize)]
+
+    def before():
+        for page in pages:
+            for feat in (formatResp(row) for row in page):
                 row = []
                 for field in feature_fields[1:]:
                     if len(str(feat[field])) > 255:
                         row.append(feat[field][:254])
                     else:
                         row.append(feat[field])
-                cursor.insertRow([shape]+row)
-                drawProgressBar(fullResponse.index(feat)/len(fullResponse))
-        print("\nFeature Class Set Up.")
-    else:
-        print(str(r.json()['metadata']['skip'] + r.json()['metadata']['top']) +
-        '/' + str(r.json()['metadata']['totalRecords']))
-        skipCounter = r.json()['metadata']['skip'] + 4000
-        doQuery()
+                [None]+row
+
+    def after():
+        for page in pages:
+            for feat in formatPage(page):
+                makeRow(None, feat)
 
-doQuery()
-print('Executed in {}'.format(datetime.datetime.now() - startTime))
+    parseDate.cache_clear()
+    results = {}
+    for name, run in (("per record", before), ("compiled", after)):
+        start = time.perf_counter()
+        run()
+        results[name] = numRecords / (time.perf_counter() - start)
+        print("{:<12} {:>10,.0f} records/s".format(name, results[name]))
+    print("Speedup: {:.2f}x".format(results["compiled"] / results["per record"]))
+    return results
+
+def makeSampleShape(recordID):
+    # Made up square parcel WKB, spread over a grid in state plane feet
+    x, y = 580000 + recordID % 200 * 150, 680000 + recordID // 200 % 200 * 150
+    ring = [(x, y), (x, y + 100), (x + 100, y + 100), (x + 100, y), (x, y)]
+    return struct.pack("<BIII", 1, 3, 1, len(ring)) + struct.pack("<10d", *(c for xy in ring for c in xy))
+
+def benchmarkSinks(numRecords=50000, folder=None, pageSize=pageSize):
+    # Records per second written by each sink that can run here, from made up records and shapes
+    if folder is None:
+        # Removed once the timings are done
+        with tempfile.TemporaryDirectory() as folder:
+            return benchmarkSinks(numRecords, folder, pageSize)
+    records = formatPage([makeSampleRecord(i) for i in range(1, numRecords + 1)])
+    pages = [[(makeSampleShape(feat['Record_ID']), feat) for feat in records[i:i + pageSize]]
+        for i in range(0, numRecords, pageSize)]
+    outputs = [os.path.join(folder, "Quickbase_PZO_Applications" + ext) for ext in (".geojsonl", ".gpkg")]
+    if Util_FeatureSinks.ogr is not None:
+        outputs.append(os.path.join(folder, "Quickbase_PZO_Applications.fgb"))
+    if arcpy is not None:
+        outputs.append(makeFeatureClass())
+    results = {}
+    for output in outputs:
+        start = time.perf_counter()
+        with Util_FeatureSinks.makeSink(output, outputSchema, outputWkid) as sink:
+            for page in pages:
+                sink.write([makeRow(shape, feat) for shape, feat in page])
+        results[output] = numRecords / (time.perf_counter() - start)
+        size = os.path.getsize(output) if os.path.isfile(output) else 0
+        print("{:<60} {:>10,.0f} records/s {:>8.1f} MB".format(output, results[output], size / 1e6))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Quickbase board records to a parcel feature class")
+    parser.add_argument("--incremental", action="store_true",
+        help="only pull records changed since the last sync and update those features in {}".format(syncFeatureClass))
+    parser.add_argument("--benchmark-format", type=int, metavar="N",
+        help="time formatting N made up records per record vs with the compiled field plans, then exit")
+    parser.add_argument("--output",
+        help="write to a .geojsonl (state plane coordinates, not RFC 7946), .gpkg or .fgb file (works without arcpy) or an existing feature class, "
+             "instead of a new in_memory feature class")
+    parser.add_argument("--benchmark-sinks", type=int, metavar="N",
+        help="time writing N made up records with each output that can run here, then exit")
+    parser.add_argument("--api-url", default=apiUrl,
+        help="Quickbase API to query, e.g. a local stub server (default {})".format(apiUrl))
+    parser.add_argument("--blocklot-separator",
+        help="normalize block/lot text like \"Block 12 Lots 3-5\" to IDs with this separator (e.g. -), off by default")
+    parser.add_argument("--checkpoint",
+        help="SQLite file of finished pages to resume from (default next to a file --output, otherwise {})".format(pageCheckpoint))
+    parser.add_argument("--parcel-cache",
+        help="SQLite cache of parcel shapes by block-lot (default next to a file --output, otherwise {})".format(parcelCache))
+    args = parser.parse_args()
+    apiUrl = args.api_url
+    blockLotSeparator = args.blocklot_separator
+    # File outputs keep their checkpoint and parcel cache alongside them, so they run anywhere
+    checkpointPath, parcelCache = pageCheckpoint, parcelCache
+    if args.output and os.path.splitext(args.output)[1].lower() in Util_FeatureSinks.sinkTypes:
+        outputFolder = os.path.dirname(os.path.abspath(args.output))
+        checkpointPath = os.path.join(outputFolder, os.path.basename(pageCheckpoint))
+        parcelCache = os.path.join(outputFolder, os.path.basename(parcelCache))
+    checkpointPath = args.checkpoint or checkpointPath
+    parcelCache = args.parcel_cache or parcelCache
+    if args.benchmark_format:
+        benchmarkFormat(args.benchmark_format)
+    elif args.benchmark_sinks:
+        benchmarkSinks(args.benchmark_sinks)
+    elif args.incremental:
+        syncRecords()
+    else:
+        doQuery(args.output or makeFeatureClass(), checkpointPath)
+    print('Executed in {}'.format(datetime.datetime.now() - startTime))
@@ -0,0 +1,127 @@
+import argparse
+import collections
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import time
+
+import Script_DBRecordsToGISParcels as qb
+import Util_FeatureSinks
+from Script_QuickbaseStubServer import serveStub
+
+# Runs the whole fetch -> format -> join -> write pipeline against the local Quickbase stub,
+# reporting records per second and where the time went, at a few sizes
+# Parcels come from a made up WKB parcel cache and features go to a file, so neither arcpy nor credentials are needed
+
+sizes = (10000, 100000, 1000000)
+
+def timeStage(items, timings, name, upstream=()):
+    # Time spent handing out each item, less the time the stages before it took meanwhile
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        before = sum(timings[stage] for stage in upstream)
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            timings[name] += time.perf_counter() - start - (sum(timings[stage] for stage in upstream) - before)
+        yield item
+
+class TimedSink(Util_FeatureSinks.FeatureSink):
+    # Passes pages on to another sink, timing the writes
+    def __init__(self, sink, timings):
+        self.sink = sink
+        self.timings = timings
+
+    def write(self, rows):
+        start = time.perf_counter()
+        self.sink.write(rows)
+        self.timings["write"] += time.perf_counter() - start
+
+    def close(self):
+        self.sink.close()
+
+def startStubProcess(**options):
+    # Stub in its own process, so making up records doesn't take the GIL from the pipeline being timed
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = multiprocessing.Process(target=serveStub, args=(port,), kwargs=options, daemon=True)
+    process.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, "http://127.0.0.1:{}".format(port)
+
+def makeParcelCache(path):
+    # Shape for every block-lot the made up records use (they repeat every 5000 records)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS parcels (blocklot TEXT PRIMARY KEY, wkb BLOB)")
+    blocklots = set(bl for feat in qb.formatPage([qb.makeSampleRecord(i) for i in range(1, 5001)])
+                    for bl in qb.makeBlockLotList(feat))
+    conn.executemany("INSERT OR REPLACE INTO parcels (blocklot, wkb) VALUES (?, ?)",
+        [(bl, qb.makeSampleShape(i)) for i, bl in enumerate(sorted(blocklots))])
+    # Version of the made up parcel dataset, as openParcelCache records it
+    conn.execute("CREATE TABLE IF NOT EXISTS cache_state (name TEXT PRIMARY KEY, value TEXT)")
+    conn.executemany("INSERT OR REPLACE INTO cache_state (name, value) VALUES (?, ?)", [
+        ("path", "sample parcels"), ("rows", str(len(blocklots))),
+        ("extent", "580000 680000 610100 710100"), ("wkid", str(qb.outputWkid))])
+    conn.commit()
+    conn.close()
+
+def runPipeline(apiUrl, folder, extension=".gpkg"):
+    qb.apiUrl = apiUrl
+    timings = collections.Counter()
+    start = time.perf_counter()
+    # The fetch thread's time is spent alongside the rest, fetch (waiting) is how long the rest sat waiting on it
+    pages = qb.queuePages(timeStage(qb.fetchAllPages(), timings, "fetch (thread)"))
+    pages = timeStage(pages, timings, "fetch (waiting)")
+    formatted = timeStage(qb.formatPages(pages), timings, "format", ["fetch (waiting)"])
+    joined = timeStage(qb.joinPagesWkb(formatted, os.path.join(folder, "ParcelCache.sqlite")),
+        timings, "join", ["fetch (waiting)", "format"])
+    output = os.path.join(folder, "Quickbase_PZO_Applications" + extension)
+    with TimedSink(Util_FeatureSinks.makeSink(output, qb.outputSchema, qb.outputWkid), timings) as sink:
+        qb.writeFeatures(sink, joined)
+    total = time.perf_counter() - start
+    timings["other"] = total - sum(timings[stage] for stage in ("fetch (waiting)", "format", "join", "write"))
+    return total, timings
+
+def runBenchmark(sizes=sizes, latency=0.0, maxTop=qb.maxPageSize, extension=".gpkg", folder=None):
+    folder = folder or tempfile.mkdtemp()
+    makeParcelCache(os.path.join(folder, "ParcelCache.sqlite"))
+    results = {}
+    for numRecords in sizes:
+        process, apiUrl = startStubProcess(numRecords=numRecords, maxTop=maxTop, latency=latency)
+        try:
+            total, timings = runPipeline(apiUrl, folder, extension)
+        finally:
+            process.terminate()
+            process.join()
+        results[numRecords] = total, timings
+        print("\n{:,} Records in {:.1f}s, {:,.0f} records/s".format(numRecords, total, numRecords / total))
+        for stage in ("fetch (thread)", "fetch (waiting)", "format", "join", "write", "other"):
+            print("  {:<16} {:>8.2f}s {:>5.1f}%".format(stage, timings[stage], 100 * timings[stage] / total))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the Quickbase to parcels pipeline against a local stub server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(sizes), help="numbers of records to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stub holds back each page")
+    parser.add_argument("--max-top", type=int, default=qb.maxPageSize, help="most records the stub sends per page")
+    parser.add_argument("--format", default=".gpkg", choices=sorted(Util_FeatureSinks.sinkTypes), help="output file type")
+    parser.add_argument("--keep", help="folder to leave the outputs in, otherwise a temporary folder is removed after")
+    args = parser.parse_args()
+    folder = args.keep or tempfile.mkdtemp()
+    try:
+        runBenchmark(args.sizes, args.latency, args.max_top, args.format, folder)
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder)
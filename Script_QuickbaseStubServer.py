@@ -0,0 +1,165 @@
+import argparse
+import datetime
+import http.server
+import json
+import random
+import re
+import threading
+import time
+
+from Script_DBRecordsToGISParcels import dateModifiedField, fields, makeSampleRecord
+
+# Local stand-in for the Quickbase records query API, serving made up records shaped like the real ones
+# Can throttle or fail requests on purpose, to check the client backs off, retries and resumes
+# Run it, then point the script at it: Script_DBRecordsToGISParcels.py --api-url http://localhost:8765
+
+# Number of records served, most records Quickbase sends per page however many are asked for,
+# send a 429 every N requests (0 for never) with this Retry-After, and chance of a 503 on any request
+numRecords = 10000
+maxTop = 5000
+throttleEvery = 0
+retryAfter = 1
+errorRate = 0.0
+# Seconds each response is held back, plus up to this much more at random
+latency = 0.0
+jitter = 0.0
+# Records are modified a minute apart from here, so the incremental sync's where clause can be tried
+firstModified = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+onOrAfterFilter = re.compile(r"^\{(\d+)\.OAF\.'([^']*)'\}$")
+
+def getModified(recordID):
+    return (firstModified + datetime.timedelta(minutes=recordID)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class QuickbaseStub(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, numRecords=numRecords, maxTop=maxTop, throttleEvery=throttleEvery,
+                 retryAfter=retryAfter, errorRate=errorRate, seed=None, latency=latency, jitter=jitter):
+        super().__init__(address, QueryHandler)
+        self.numRecords = numRecords
+        self.maxTop = maxTop
+        self.throttleEvery = throttleEvery
+        self.retryAfter = retryAfter
+        self.errorRate = errorRate
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def nextRequest(self):
+        # Count the request and decide whether it gets throttled or fails
+        with self.lock:
+            self.requests += 1
+            if self.throttleEvery and self.requests % self.throttleEvery == 0:
+                return 429
+            if self.random.random() < self.errorRate:
+                return 503
+        return 200
+
+    def getDelay(self):
+        # Seconds to hold a response back, drawn from the seeded generator (shared by the handler threads)
+        with self.lock:
+            return self.latency + self.random.uniform(0, self.jitter)
+
+    def getFirstRecord(self, where):
+        # Record ID the where clause starts at, only the on-or-after Date Modified filter the sync uses is understood
+        if not where:
+            return 1
+        match = onOrAfterFilter.match(where)
+        if match is None or match.group(1) != dateModifiedField:
+            raise ValueError("Unsupported where clause {}".format(where))
+        # Modified times rise with Record ID, so binary search for the first one on or after
+        low, high = 1, self.numRecords + 1
+        while low < high:
+            recordID = (low + high) // 2
+            if getModified(recordID) < match.group(2):
+                low = recordID + 1
+            else:
+                high = recordID
+        return low
+
+    def query(self, body):
+        # Records come back in Record ID order, which is also the order the real sortBy gives the made up dates
+        options = body.get("options", {})
+        skip = int(options.get("skip", 0))
+        top = min(int(options.get("top", self.maxTop)), self.maxTop)
+        select = [str(fieldID) for fieldID in body.get("select") or [field[0] for field in fields]]
+        firstRecord = self.getFirstRecord(body.get("where"))
+        totalRecords = self.numRecords - firstRecord + 1
+        data = []
+        for recordID in range(firstRecord + skip, firstRecord + min(skip + top, totalRecords)):
+            record = makeSampleRecord(recordID)
+            record[dateModifiedField] = {"value": getModified(recordID)}
+            data.append({fieldID: record.get(fieldID, {"value": ""}) for fieldID in select})
+        return {
+            "data": data,
+            "fields": [{"id": int(field[0]), "label": field[3]} for field in fields if field[0] in select],
+            "metadata": {
+                "totalRecords": totalRecords,
+                "numRecords": len(data),
+                "numFields": len(select),
+                "skip": skip
+            }
+        }
+
+class QueryHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path != "/v1/records/query":
+            return self.sendJson(404, {"message": "Not Found"})
+        status = self.server.nextRequest()
+        if status == 429:
+            return self.sendJson(429, {"message": "Too Many Requests"}, {"Retry-After": str(self.server.retryAfter)})
+        if status != 200:
+            return self.sendJson(status, {"message": "Service Unavailable"})
+        try:
+            response = self.server.query(body)
+        except ValueError as e:
+            return self.sendJson(400, {"message": "Bad Request", "description": str(e)})
+        if self.server.latency or self.server.jitter:
+            time.sleep(self.server.getDelay())
+        self.sendJson(200, response)
+
+    def sendJson(self, status, obj, headers={}):
+        payload = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # Quiet, there's a request for every page
+        pass
+
+def startStub(port=0, **options):
+    # Serve in a background thread, returns the server and its base url (port 0 picks a free port)
+    server = QuickbaseStub(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+def serveStub(port, **options):
+    # Serve until stopped, as the target of a separate process
+    QuickbaseStub(("127.0.0.1", port), **options).serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Quickbase records query API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--records", type=int, default=numRecords, help="number of records served")
+    parser.add_argument("--max-top", type=int, default=maxTop, help="most records sent per page")
+    parser.add_argument("--throttle-every", type=int, default=throttleEvery, help="send a 429 every N requests")
+    parser.add_argument("--retry-after", type=float, default=retryAfter, help="Retry-After seconds sent with a 429")
+    parser.add_argument("--error-rate", type=float, default=errorRate, help="chance of a 503 on any request")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--latency", type=float, default=latency, help="seconds each response is held back")
+    parser.add_argument("--jitter", type=float, default=jitter, help="up to this many more seconds at random")
+    args = parser.parse_args()
+    server = QuickbaseStub(("127.0.0.1", args.port), args.records, args.max_top, args.throttle_every,
+                           args.retry_after, args.error_rate, args.seed, args.latency, args.jitter)
+    print("Serving {} Records at http://127.0.0.1:{}".format(args.records, args.port))
+    server.serve_forever()
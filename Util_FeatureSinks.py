@@ -0,0 +1,283 @@
+import json
+import os
+import sqlite3
+import struct
+
+# Streaming feature writers, so records can go somewhere other than an ArcGIS feature class
+# Every sink takes a schema of (name, type) pairs using the arcpy field types (SHORT, FLOAT, TEXT, DATE),
+# then pages of rows [shape, value, value, ...] in schema order, each page written in one batch
+# Shapes can be arcpy geometries or WKB, so the non-arcpy sinks run without an ArcGIS license
+
+# arcpy and GDAL are optional, only their sinks need them
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+try:
+    from osgeo import ogr, osr
+except ImportError:
+    ogr = osr = None
+
+## WKB helpers
+wkbTypes = {1: "Point", 2: "LineString", 3: "Polygon", 4: "MultiPoint", 5: "MultiLineString", 6: "MultiPolygon", 7: "GeometryCollection"}
+
+def toWkb(shape):
+    # WKB bytes of an arcpy geometry, or the shape itself if it's already WKB
+    if shape is None or isinstance(shape, bytes):
+        return shape
+    if isinstance(shape, (bytearray, memoryview)):
+        return bytes(shape)
+    return bytes(shape.WKB)
+
+def readWkb(wkb, offset=0):
+    # GeoJSON geometry of the WKB at offset, and the offset just past it (M values are dropped)
+    order = "<" if wkb[offset] == 1 else ">"
+    code, = struct.unpack_from(order + "I", wkb, offset + 1)
+    offset += 5
+    if code & 0xE0000000:
+        # EWKB flags Z, M and an embedded SRID in the high bits
+        hasZ, hasM = bool(code & 0x80000000), bool(code & 0x40000000)
+        if code & 0x20000000:
+            offset += 4
+        kind = code & 0xFF
+    else:
+        # ISO WKB adds 1000 for Z, 2000 for M and 3000 for both
+        hasZ, hasM = code // 1000 in (1, 3), code // 1000 in (2, 3)
+        kind = code % 1000
+    point = struct.Struct(order + "d" * (2 + hasZ + hasM))
+    keep = 3 if hasZ else 2
+
+    def readPoints(offset):
+        count, = struct.unpack_from(order + "I", wkb, offset)
+        offset += 4
+        coords = [list(point.unpack_from(wkb, offset + i * point.size)[:keep]) for i in range(count)]
+        return coords, offset + count * point.size
+
+    if kind == 1:
+        coords = list(point.unpack_from(wkb, offset)[:keep])
+        offset += point.size
+    elif kind == 2:
+        coords, offset = readPoints(offset)
+    elif kind == 3:
+        count, = struct.unpack_from(order + "I", wkb, offset)
+        offset += 4
+        coords = []
+        for _ in range(count):
+            ring, offset = readPoints(offset)
+            coords.append(ring)
+    elif kind in (4, 5, 6, 7):
+        count, = struct.unpack_from(order + "I", wkb, offset)
+        offset += 4
+        parts = []
+        for _ in range(count):
+            part, offset = readWkb(wkb, offset)
+            parts.append(part)
+        if kind == 7:
+            return {"type": "GeometryCollection", "geometries": parts}, offset
+        coords = [part["coordinates"] for part in parts]
+    else:
+        raise ValueError("Unsupported WKB geometry type {}".format(code))
+    return {"type": wkbTypes[kind], "coordinates": coords}, offset
+
+def wkbToGeoJSON(wkb):
+    return None if wkb is None else readWkb(wkb)[0]
+
+def mergeWkb(wkbs):
+    # Collect the polygons of several shapes into one 2D multipolygon (without dissolving shared edges)
+    wkbs = [wkb for wkb in wkbs if wkb is not None]
+    if len(wkbs) < 2:
+        return wkbs[0] if wkbs else None
+    polygons = []
+    for wkb in wkbs:
+        geometry = wkbToGeoJSON(wkb)
+        if geometry["type"] == "Polygon":
+            polygons.append(geometry["coordinates"])
+        elif geometry["type"] == "MultiPolygon":
+            polygons.extend(geometry["coordinates"])
+    parts = [struct.pack("<BII", 1, 6, len(polygons))]
+    for rings in polygons:
+        parts.append(struct.pack("<BII", 1, 3, len(rings)))
+        for ring in rings:
+            parts.append(struct.pack("<I", len(ring)))
+            parts.append(struct.pack("<{}d".format(2 * len(ring)), *(c for xy in ring for c in xy[:2])))
+    return b"".join(parts)
+
+## Sinks
+class FeatureSink:
+    # Base sink, used as a context manager so the output is always closed
+    def __init__(self, path, schema, wkid):
+        self.path = path
+        self.schema = list(schema)
+        self.names = [name for name, fieldType in self.schema]
+        self.wkid = wkid
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class ArcpySink(FeatureSink):
+    # Insert cursor on an existing feature class with the schema's fields
+    # Its rows are deleted first, like the file sinks replace their file, unless appending (e.g. the incremental sync)
+    def __init__(self, path, schema, wkid, append=False):
+        if arcpy is None:
+            raise ImportError("arcpy is needed to write a feature class, use a .geojsonl, .gpkg or .fgb output instead")
+        super().__init__(path, schema, wkid)
+        if not append:
+            arcpy.management.TruncateTable(path)
+        self.spatialReference = arcpy.SpatialReference(wkid)
+        self.cursor = arcpy.da.InsertCursor(path, ["SHAPE@"] + self.names)
+
+    def write(self, rows):
+        for row in rows:
+            shape = row[0]
+            if isinstance(shape, (bytes, bytearray, memoryview)):
+                row = [arcpy.FromWKB(bytes(shape), self.spatialReference)] + list(row[1:])
+            self.cursor.insertRow(row)
+        self.count += len(rows)
+
+    def close(self):
+        del self.cursor
+
+class GeoJSONSink(FeatureSink):
+    # Newline-delimited GeoJSON, one feature per line in the output's coordinate system (not reprojected to WGS84)
+    # That makes it pre-RFC 7946 GeoJSON, so each feature names its CRS with the 2008 spec's crs member
+    def __init__(self, path, schema, wkid):
+        super().__init__(path, schema, wkid)
+        self.crs = {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG::{}".format(wkid)}}
+        self.file = open(path, "w", encoding="utf-8", newline="\n")
+
+    def write(self, rows):
+        lines = []
+        for row in rows:
+            lines.append(json.dumps({
+                "type": "Feature",
+                "crs": self.crs,
+                "geometry": wkbToGeoJSON(toWkb(row[0])),
+                "properties": dict(zip(self.names, row[1:]))
+            }))
+        self.file.write("\n".join(lines) + "\n" if lines else "")
+        self.file.flush()
+        self.count += len(rows)
+
+    def close(self):
+        self.file.close()
+
+# GeoPackage column types for the arcpy field types
+gpkgTypes = {"SHORT": "INTEGER", "LONG": "INTEGER", "FLOAT": "DOUBLE", "DOUBLE": "DOUBLE", "TEXT": "TEXT", "DATE": "DATETIME"}
+wgs84Definition = ('GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],'
+                   'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433],AUTHORITY["EPSG","4326"]]')
+
+class GeoPackageSink(FeatureSink):
+    # GeoPackage written straight through sqlite3, one table named after the file
+    def __init__(self, path, schema, wkid):
+        super().__init__(path, schema, wkid)
+        if os.path.exists(path):
+            os.remove(path)
+        self.table = os.path.splitext(os.path.basename(path))[0]
+        self.dates = [i + 1 for i, (name, fieldType) in enumerate(self.schema) if fieldType == "DATE"]
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            PRAGMA application_id = 1196444487;
+            PRAGMA user_version = 10300;
+            CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY,
+                organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+            CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+                description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                srs_id INTEGER, CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+            CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+                srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+                CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+                CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+                CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+        """)
+        # Use the real definition when arcpy can give it, GDAL falls back on the EPSG code otherwise
+        definition = arcpy.SpatialReference(wkid).exportToString() if arcpy is not None else "undefined"
+        self.conn.executemany("INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)", [
+            ("Undefined cartesian SRS", -1, "NONE", -1, "undefined", None),
+            ("Undefined geographic SRS", 0, "NONE", 0, "undefined", None),
+            ("WGS 84 geodetic", 4326, "EPSG", 4326, wgs84Definition, None),
+        ] + ([("EPSG:{}".format(wkid), wkid, "EPSG", wkid, definition, None)] if wkid not in (-1, 0, 4326) else []))
+        columns = "".join(', "{}" {}'.format(name, gpkgTypes.get(fieldType, "TEXT")) for name, fieldType in self.schema)
+        self.conn.execute('CREATE TABLE "{}" (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom GEOMETRY{})'.format(self.table, columns))
+        self.conn.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)",
+            (self.table, self.table, wkid))
+        self.conn.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'GEOMETRY', ?, 0, 0)", (self.table, wkid))
+        self.conn.commit()
+        # Standard geometry header: magic, version 0, little endian with no envelope, srs id
+        self.header = b"GP\x00\x01" + struct.pack("<i", wkid)
+        self.insert = 'INSERT INTO "{}" (geom{}) VALUES (?{})'.format(
+            self.table, "".join(', "{}"'.format(name) for name in self.names), ", ?" * len(self.names))
+
+    def write(self, rows):
+        values = []
+        for row in rows:
+            wkb = toWkb(row[0])
+            row = [None if wkb is None else self.header + wkb] + list(row[1:])
+            # GeoPackage datetimes are ISO 8601
+            for i in self.dates:
+                if row[i]:
+                    row[i] = row[i].replace(" ", "T") + "Z"
+            values.append(row)
+        # One transaction per page
+        with self.conn:
+            self.conn.executemany(self.insert, values)
+        self.count += len(rows)
+
+    def close(self):
+        with self.conn:
+            self.conn.execute("UPDATE gpkg_contents SET last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE table_name = ?", (self.table,))
+        self.conn.close()
+
+class FlatGeobufSink(FeatureSink):
+    # FlatGeobuf through GDAL/OGR
+    def __init__(self, path, schema, wkid):
+        if ogr is None:
+            raise ImportError("GDAL (osgeo) is needed to write FlatGeobuf, use a .geojsonl or .gpkg output instead")
+        super().__init__(path, schema, wkid)
+        ogrTypes = {"SHORT": ogr.OFTInteger, "LONG": ogr.OFTInteger, "FLOAT": ogr.OFTReal, "DOUBLE": ogr.OFTReal,
+                    "TEXT": ogr.OFTString, "DATE": ogr.OFTDateTime}
+        driver = ogr.GetDriverByName("FlatGeobuf")
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        spatialReference = osr.SpatialReference()
+        spatialReference.ImportFromEPSG(wkid)
+        self.dataset = driver.CreateDataSource(path)
+        self.layer = self.dataset.CreateLayer(os.path.splitext(os.path.basename(path))[0], spatialReference, ogr.wkbUnknown)
+        for name, fieldType in self.schema:
+            self.layer.CreateField(ogr.FieldDefn(name, ogrTypes.get(fieldType, ogr.OFTString)))
+        self.definition = self.layer.GetLayerDefn()
+
+    def write(self, rows):
+        # FlatGeobuf has no transactions, features are buffered by the driver and written out on close
+        for row in rows:
+            feature = ogr.Feature(self.definition)
+            for i, value in enumerate(row[1:]):
+                if value is not None:
+                    feature.SetField(i, value)
+            wkb = toWkb(row[0])
+            if wkb is not None:
+                feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb))
+            self.layer.CreateFeature(feature)
+        self.count += len(rows)
+
+    def close(self):
+        self.layer = self.definition = None
+        self.dataset = None
+
+# Output file extensions, anything else is taken to be an arcpy feature class
+# (no .geojsons, RFC 8142 GeoJSON text sequences are WGS84 only)
+sinkTypes = {".geojsonl": GeoJSONSink, ".ndjson": GeoJSONSink,
+             ".gpkg": GeoPackageSink, ".fgb": FlatGeobufSink}
+
+def makeSink(path, schema, wkid):
+    return sinkTypes.get(os.path.splitext(path)[1].lower(), ArcpySink)(path, schema, wkid)
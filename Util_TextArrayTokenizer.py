@@ -0,0 +1,94 @@
+import functools
+import re
+
+# Splits text arrays of IDs (block-lots, lots, etc.) written out by hand into a clean list
+# Handles mixed delimiters and stray spaces, and given a block/lot separator also normalizes
+# "Block 12 Lots 3, 4" style block/lot text, "12_3" IDs and ranges like "Lots 12-15" or "Lots 3 thru 7"
+# Results are memoized, since the same lists come up over and over
+
+# Delimiters used when none are given ("&" also splits on the word "and"),
+# separator of Newark's "12-3" parcel block-lots, and the largest range expanded
+defaultDelimiters = ",;/&"
+blockLotSeparator = "-"
+maxRangeSize = 500
+
+# "Block 12 Lot 3", "Blk. 12, Lots 3-5", "B 12 L 3"
+blockLotText = re.compile(r"^(?:block|blk|b)\.?\s*(\d[\w.]*)\s*,?\s*(?:lots?|l)\.?\s*(\d.*)$", re.I)
+# Start of another block inside an item, like the second one in "Block 12 Lots 1, 2 Block 13 Lot 4"
+blockBoundary = re.compile(r"\s+(?=(?:block|blk)\.?\s*\d)", re.I)
+# "Block 12" with its lots in the next items
+blockText = re.compile(r"^(?:block|blk)\.?\s*(\d[\w.]*)$", re.I)
+# "Lot 3", "Lots 3 thru 7", "L. 3" (but not an ID like "L123")
+lotText = re.compile(r"^(?:lots?\.?|l\.|l(?=\s))\s*(\d.*)$", re.I)
+# "12-3", "12 - 3", "12_3"
+blockLotID = re.compile(r"^([\w.]+?)\s*[-_]\s*([\w.]+)$")
+# "3 thru 7", "3 through 7", "3 to 7", and "3-7" when the block is already known
+wordRange = re.compile(r"^(\d+)\s*(?:thru|through|to)\s*(\d+)$", re.I)
+dashRange = re.compile(r"^(\d+)\s*-\s*(\d+)$")
+
+@functools.lru_cache(maxsize=None)
+def getSplitter(delimiters):
+    """Pattern splitting on any of the delimiters, and spaces around them."""
+    words = r"|\band\b" if "&" in delimiters else ""
+    return re.compile(r"\s*(?:[{}]{})\s*".format(re.escape(delimiters), words), re.I)
+
+def expandRange(start, end):
+    """Numbers from start to end, keeping any zero padding, or None if it isn't a sensible range."""
+    first, last = int(start), int(end)
+    if last < first or last - first >= maxRangeSize:
+        return None
+    width = len(start) if start.startswith("0") else 0
+    return [str(n).zfill(width) for n in range(first, last + 1)]
+
+def parseLots(text, block, separator):
+    """IDs for a lot, or range of lots, on the given block (or on their own if there's no block)."""
+    text = " ".join(text.split())
+    match = wordRange.match(text) or (dashRange.match(text) if block is not None else None)
+    lots = expandRange(*match.groups()) if match else None
+    if lots is None:
+        lots = [text]
+    return [lot if block is None else block + separator + lot for lot in lots]
+
+@functools.lru_cache(maxsize=65536)
+def tokenize(text, delimiters=defaultDelimiters, separator=None):
+    """Tuple of the IDs in a text array, in the order listed, without repeats.
+    The IDs are only trimmed unless a separator is given, then block/lot text
+    and ranges are expanded and block-lot IDs written with that separator."""
+    if separator is None:
+        return tuple(dict.fromkeys(
+            " ".join(token.split()) for token in getSplitter(delimiters).split(text.strip()) if token))
+    ids = []
+    # Block named in an earlier item, for bare lots after it like "Block 12 Lots 3, 4"
+    block = None
+    tokens = (part for token in getSplitter(delimiters).split(text.strip()) for part in blockBoundary.split(token))
+    for token in tokens:
+        if not token:
+            continue
+        match = blockLotText.match(token)
+        if match:
+            block = match.group(1)
+            ids.extend(parseLots(match.group(2), block, separator))
+            continue
+        match = blockText.match(token)
+        if match:
+            block = match.group(1)
+            continue
+        match = lotText.match(token)
+        if match:
+            ids.extend(parseLots(match.group(1), block, separator))
+            continue
+        if block is not None:
+            # Bare lot or range of lots on the same block
+            match = wordRange.match(token) or dashRange.match(token)
+            if token.isdigit() or (match and expandRange(*match.groups())):
+                ids.extend(parseLots(token, block, separator))
+                continue
+        # Anything else is an ID on its own, which ends any earlier block
+        block = None
+        match = wordRange.match(token)
+        if match and expandRange(*match.groups()):
+            ids.extend(expandRange(*match.groups()))
+            continue
+        match = blockLotID.match(token)
+        ids.append(match.group(1) + separator + match.group(2) if match else " ".join(token.split()))
+    return tuple(dict.fromkeys(ids))